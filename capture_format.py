@@ -0,0 +1,490 @@
+import os
+import fcntl
+import yaml
+import numpy as np
+
+def metadata_file_name(save_folder, cam_name):
+    '''
+    Path of the per-camera session metadata file.
+    Params:
+        save_folder (str): folder the camera's timestamps and frames are saved in
+        cam_name (str): name of camera (od/os/cy)
+    Returns:
+        file_name (str): path to metadata yaml
+    '''
+    return(os.path.join(save_folder, f"metadata_{cam_name}.yaml"))
+
+def write_session_metadata(save_folder, cam_name, **fields):
+    '''
+    Add fields to the session metadata file for a camera, keeping what is already there.
+    Acquisition and save workers both record into this file, so updates are locked.
+    Params:
+        save_folder (str): folder the camera's timestamps and frames are saved in
+        cam_name (str): name of camera (od/os/cy)
+        fields: key/values to record
+    '''
+    with open(metadata_file_name(save_folder, cam_name), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        metadata = yaml.safe_load(f) or {}
+        metadata.update(fields)
+        f.seek(0)
+        f.truncate()
+        yaml.dump(metadata, f, default_flow_style=False)
+
+def reset_session_metadata(save_folder, cam_name):
+    '''
+    Remove a camera's session metadata before a new session is recorded into the same folder,
+    so nothing from an earlier session (eg its save_error) carries over.
+    '''
+    file_name = metadata_file_name(save_folder, cam_name)
+    if os.path.exists(file_name):
+        os.remove(file_name)
+
+def read_session_metadata(save_folder, cam_name):
+    '''
+    Read the session metadata recorded for a camera.
+    Params:
+        save_folder (str): folder the camera's timestamps and frames are saved in
+        cam_name (str): name of camera (od/os/cy)
+    Returns:
+        metadata (dict): recorded fields, empty if no metadata was saved
+    '''
+    file_name = metadata_file_name(save_folder, cam_name)
+    if not os.path.exists(file_name):
+        return({})
+    with open(file_name, 'r') as f:
+        metadata = yaml.safe_load(f) or {}
+    #striped volumes only point back to the session folder holding the real metadata
+    if('session_folder' in metadata):
+        session_folder = os.path.normpath(os.path.join(save_folder, metadata['session_folder']))
+        if not os.path.exists(metadata_file_name(session_folder, cam_name)):
+            raise ValueError(f'{file_name} points to session folder {session_folder}, which has no {cam_name} metadata')
+        return(read_session_metadata(session_folder, cam_name))
+    return(metadata)
+
+def write_metadata_pointer(volume, save_folder, cam_name):
+    '''
+    Record in a volume that batch files are striped onto where the camera's session metadata lives,
+    so batch files on that volume can be read on their own. The path is stored relative to the volume.
+    Params:
+        volume (str): folder batch files are striped into
+        save_folder (str): folder the camera's timestamps and metadata are saved in
+        cam_name (str): name of camera (od/os/cy)
+    '''
+    if(os.path.abspath(volume) == os.path.abspath(save_folder)):
+        return()
+    with open(metadata_file_name(volume, cam_name), 'w') as f:
+        yaml.dump({'session_folder': os.path.relpath(os.path.abspath(save_folder), os.path.abspath(volume))},
+                  f, default_flow_style=False)
+
+def timing_file_name(save_folder, cam_name=None):
+    '''
+    Path of the timing statistics a save worker keeps for a camera, or of the
+    session timing summary they are merged into if cam_name is None.
+    '''
+    if(cam_name is None):
+        return(os.path.join(save_folder, 'timing_summary.yaml'))
+    return(os.path.join(save_folder, f'timing_{cam_name}.yaml'))
+
+def read_timing_summary(save_folder):
+    '''
+    Read the timing summary written at the end of a collection.
+    Returns:
+        summary (dict): timing summary, empty if there is none
+    '''
+    file_name = timing_file_name(save_folder)
+    if not os.path.exists(file_name):
+        return({})
+    with open(file_name, 'r') as f:
+        return(yaml.safe_load(f) or {})
+
+# one fixed size record per saved frame, appended by the save worker in timestamps_{cam}.idx
+#   index: collection index (position of the frame in the saved stream)
+#   nframe: camera frame counter
+#   tsSec, tsUSec: camera timestamp
+#   file_id: batch file number the frame was written into
+#   offset: byte offset of the frame within that batch file
+TIMESTAMP_INDEX_DTYPE = np.dtype([('index', '<u8'),
+                                  ('nframe', '<u8'),
+                                  ('offset', '<u8'),
+                                  ('tsSec', '<u4'),
+                                  ('tsUSec', '<u4'),
+                                  ('file_id', '<u4')])
+
+def timestamp_index_file_name(save_folder, cam_name):
+    '''
+    Path of the binary timestamp index for a camera.
+    Params:
+        save_folder (str): folder the camera's timestamps and frames are saved in
+        cam_name (str): name of camera (od/os/cy)
+    Returns:
+        file_name (str): path to timestamp index
+    '''
+    return(os.path.join(save_folder, f"timestamps_{cam_name}.idx"))
+
+def load_timestamp_index(index_file):
+    '''
+    Memory map a binary timestamp index as a structured array.
+    Params:
+        index_file (str): path to timestamps_{cam}.idx file
+    Returns:
+        index (structured np array): one TIMESTAMP_INDEX_DTYPE record per saved frame
+    '''
+    nrecords = os.path.getsize(index_file) // TIMESTAMP_INDEX_DTYPE.itemsize
+    if(nrecords == 0):
+        return(np.zeros(0, dtype=TIMESTAMP_INDEX_DTYPE))
+    return(np.memmap(index_file, dtype=TIMESTAMP_INDEX_DTYPE, mode='r', shape=(nrecords,)))
+
+def timestamp_index_seconds(index):
+    '''
+    Camera timestamps in seconds from a timestamp index.
+    '''
+    return(index['tsSec'] + index['tsUSec'] * 1e-6)
+
+class TimestampIndexWriter:
+    '''
+    Collect timestamp index records in a preallocated array and append them to disk in bulk.
+    Params:
+        index_file (str): path to timestamps_{cam}.idx file, overwritten
+        chunk_records (int): records to hold before appending to disk
+    '''
+    def __init__(self, index_file, chunk_records=1000):
+        self.file = open(index_file, 'wb')
+        self.records = np.zeros(chunk_records, dtype=TIMESTAMP_INDEX_DTYPE)
+        self.n = 0
+
+    def append(self, index, nframe, tsSec, tsUSec, file_id, offset):
+        '''
+        Add the record for one saved frame.
+        '''
+        self.records[self.n] = (index, nframe, offset, tsSec, tsUSec, file_id)
+        self.n += 1
+        if(self.n == len(self.records)):
+            self.flush()
+
+    def flush(self):
+        '''
+        Append the collected records to disk.
+        '''
+        self.file.write(self.records[:self.n].tobytes())
+        self.file.flush()
+        self.n = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def stripe_pattern(n_volumes, volume_weights=None):
+    '''
+    One period of the order batch files are spread over volumes in (smooth weighted round robin).
+    Params:
+        n_volumes (int): number of volumes
+        volume_weights (list of int): relative share of batch files for each volume (eg sustained MB/s),
+                                      equal shares if None
+    Returns:
+        pattern (list of int): volume index for batch file i is pattern[i % len(pattern)]
+    '''
+    if(volume_weights is None):
+        volume_weights = [1] * n_volumes
+    if(len(volume_weights) != n_volumes):
+        raise ValueError(f'Got {len(volume_weights)} volume weights for {n_volumes} volumes')
+    volume_weights = [int(w) for w in volume_weights]
+    total = sum(volume_weights)
+    current = [0] * n_volumes
+    pattern = []
+    for _ in range(total):
+        for v in range(n_volumes):
+            current[v] += volume_weights[v]
+        best = current.index(max(current))
+        current[best] -= total
+        pattern.append(best)
+    return(pattern)
+
+def manifest_file_name(save_folder, cam_name):
+    '''
+    Path of the batch manifest for a camera, recording which volume holds each batch file.
+    '''
+    return(os.path.join(save_folder, f"manifest_{cam_name}.tsv"))
+
+class BatchManifestWriter:
+    '''
+    Append one line per batch file (file id, first collection index, volume index, file name)
+    to a camera's manifest as each batch file is started.
+    Params:
+        manifest_file (str): path to manifest_{cam}.tsv file, overwritten
+    '''
+    def __init__(self, manifest_file):
+        self.file = open(manifest_file, 'w')
+        self.file.write('file_id\tfstart\tvolume\tfile_name\n')
+        self.file.flush()
+
+    def add(self, file_id, fstart, volume, file_name):
+        self.file.write(f'{file_id}\t{fstart}\t{volume}\t{os.path.basename(file_name)}\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_batch_manifest(save_folder, cam_name, volumes=None):
+    '''
+    A camera's batch files as recorded in its manifest.
+    Params:
+        save_folder (str): folder the camera's timestamps and metadata are saved in
+        cam_name (str): name of camera (od/os/cy)
+        volumes (list of str): volume folders to use instead of those recorded in the
+                               session metadata (eg when disks are mounted elsewhere)
+    Returns:
+        batches (dict): file id -> (first collection index, path of batch file), None if there is no manifest
+    '''
+    manifest_file = manifest_file_name(save_folder, cam_name)
+    if not os.path.exists(manifest_file):
+        return(None)
+    if(volumes is None):
+        volumes = read_session_metadata(save_folder, cam_name).get('volumes', [save_folder])
+    batches = {}
+    with open(manifest_file, 'r') as f:
+        f.readline()
+        for line in f:
+            file_id, fstart, volume, file_name = line.rstrip('\n').split('\t')
+            batches[int(file_id)] = (int(fstart), os.path.join(volumes[int(volume)], cam_name, file_name))
+    return(batches)
+
+def batch_file_paths(save_folder, cam_name, volumes=None):
+    '''
+    Paths of a camera's batch files, resolved through its manifest (see read_batch_manifest).
+    Returns:
+        paths (dict): file id -> path of batch file, None if there is no manifest
+    '''
+    batches = read_batch_manifest(save_folder, cam_name, volumes)
+    if(batches is None):
+        return(None)
+    return({file_id: path for file_id, (fstart, path) in batches.items()})
+
+# numpy dtypes of the unpacked raw image formats (xiapi writes 16 bit data little endian)
+RAW_DTYPES = {'XI_RAW8': np.dtype('u1'),
+              'XI_MONO8': np.dtype('u1'),
+              'XI_RAW16': np.dtype('<u2'),
+              'XI_MONO16': np.dtype('<u2')}
+
+# frames recorded with PFNC LSB bit packing (is_output_bit_packing), bits per pixel of each format.
+# pixels are packed back to back least significant bit first: 10 bit formats put 4 pixels in 5 bytes,
+# 12 bit formats 2 pixels in 3 bytes. They are unpacked to uint16 when read.
+PACKED_FORMATS = {'PFNC_LSB10': 10,
+                  'PFNC_LSB12': 12}
+
+def packed_format(bit_depth):
+    '''
+    Name of the PFNC LSB packed format with bit_depth bits per pixel.
+    '''
+    img_format = f'PFNC_LSB{bit_depth}'
+    if img_format not in PACKED_FORMATS:
+        raise ValueError(f'Bit packing is supported for {sorted(PACKED_FORMATS.values())} bits, not {bit_depth}')
+    return(img_format)
+
+def frame_dtype(img_format):
+    '''
+    Numpy type of decoded frames in a format.
+    '''
+    if img_format in PACKED_FORMATS:
+        return(np.dtype('<u2'))
+    return(RAW_DTYPES[img_format])
+
+def format_bit_depth(img_format):
+    '''
+    Bits per pixel of a format, for captures that did not record their bit depth.
+    '''
+    if img_format in PACKED_FORMATS:
+        return(PACKED_FORMATS[img_format])
+    return(8 * RAW_DTYPES[img_format].itemsize)
+
+def frame_nbytes(im_shape, img_format='XI_RAW8'):
+    '''
+    Bytes taken up by one saved frame.
+    Params:
+        im_shape (2ple ints): (height, width) of frames
+        img_format (str): xiapi image data format frames were saved in, or a PACKED_FORMATS format
+    '''
+    if img_format in PACKED_FORMATS:
+        return(int(np.prod(im_shape)) * PACKED_FORMATS[img_format] // 8)
+    return(int(np.prod(im_shape)) * RAW_DTYPES[img_format].itemsize)
+
+def unpack_pfnc_lsb(buffer, bit_depth, out=None):
+    '''
+    Unpack PFNC LSB packed 10 or 12 bit pixels, a whole buffer at a time.
+    Params:
+        buffer (bytes-like or np array): packed pixels, a whole number of pixel groups
+        bit_depth (int): 10 or 12
+        out (np array): contiguous uint16 array with room for every pixel to unpack into, allocated if None
+    Returns:
+        pixels (1d np array): uint16 pixels (a flat view of out if given)
+    '''
+    packed = np.frombuffer(buffer, dtype=np.uint8) if not isinstance(buffer, np.ndarray) else np.ascontiguousarray(buffer).reshape(-1)
+    group_bytes, group_pixels = {10: (5, 4), 12: (3, 2)}[bit_depth]
+    n_groups = len(packed) // group_bytes
+    if(out is None):
+        out = np.empty(n_groups * group_pixels, dtype=np.uint16)
+    pixels = out.reshape(-1, group_pixels)
+    mask = 2**bit_depth - 1
+    for j in range(group_pixels):
+        #every pixel lies within the 16 bits starting at the byte it begins in,
+        #so read those as one strided little endian uint16 per group, then shift and mask
+        bit = j * bit_depth
+        words = np.ndarray((n_groups,), dtype='<u2', buffer=packed, offset=bit // 8, strides=(group_bytes,))
+        np.right_shift(words, bit % 8, out=pixels[:, j])
+        np.bitwise_and(pixels[:, j], mask, out=pixels[:, j])
+    return(out.reshape(-1))
+
+def pack_pfnc_lsb(pixels, bit_depth):
+    '''
+    Pack pixels the way the camera does with PFNC LSB bit packing (inverse of unpack_pfnc_lsb).
+    Params:
+        pixels (np array): pixel values below 2**bit_depth, a whole number of pixel groups
+        bit_depth (int): 10 or 12
+    Returns:
+        packed (1d np array): uint8 packed bytes
+    '''
+    group_pixels = {10: 4, 12: 2}[bit_depth]
+    p = np.asarray(pixels, dtype=np.uint16).reshape(-1, group_pixels)
+    if(bit_depth == 12):
+        packed = np.stack((p[:, 0] & 0xFF,
+                           (p[:, 0] >> 8) | ((p[:, 1] & 0x0F) << 4),
+                           p[:, 1] >> 4), axis=1)
+    else:
+        packed = np.stack((p[:, 0] & 0xFF,
+                           (p[:, 0] >> 8) | ((p[:, 1] & 0x3F) << 2),
+                           (p[:, 1] >> 6) | ((p[:, 2] & 0x0F) << 4),
+                           (p[:, 2] >> 4) | ((p[:, 3] & 0x03) << 6),
+                           p[:, 3] >> 2), axis=1)
+    return(packed.astype(np.uint8).reshape(-1))
+
+def decode_frames(buffer, im_shape=(1544,2064), img_format='XI_RAW8'):
+    '''
+    Decode a buffer of back to back raw frames, without copying unless they are bit packed.
+    Params:
+        buffer (bytes-like or np array): raw frame data, a whole number of frames
+        im_shape (2ple ints): (height, width) of frames
+        img_format (str): xiapi image data format frames were saved in, or a PACKED_FORMATS format
+    Returns:
+        frames (3d np array): (N, H, W) frames
+    '''
+    if img_format in PACKED_FORMATS:
+        frames = unpack_pfnc_lsb(buffer, PACKED_FORMATS[img_format])
+    else:
+        frames = np.frombuffer(buffer, dtype=RAW_DTYPES[img_format])
+    return(frames.reshape((-1,) + tuple(im_shape)))
+
+def read_bin_frames(filename, im_shape=(1544,2064), img_format='XI_RAW8', start=0, count=-1):
+    '''
+    Read frames from a .bin batch file in one call.
+    Params:
+        filename (str): batch file to read
+        im_shape (2ple ints): (height, width) of frames
+        img_format (str): xiapi image data format frames were saved in, or a PACKED_FORMATS format
+        start (int): first frame within the file to read
+        count (int): number of frames to read, -1 for all remaining frames
+    Returns:
+        frames (3d np array): (N, H, W) frames
+    '''
+    frame_size = frame_nbytes(im_shape, img_format)
+    raw = np.fromfile(filename, dtype=np.uint8,
+                      count=count*frame_size if count >= 0 else -1,
+                      offset=start*frame_size)
+    raw = raw[:len(raw) // frame_size * frame_size]
+    return(decode_frames(raw, im_shape, img_format))
+
+def find_cameras(save_folder):
+    '''
+    Names of the cameras saved in a capture folder.
+    Params:
+        save_folder (str): capture folder (eg .../scene_camera)
+    Returns:
+        cam_names (list of str): cameras with session metadata, or for older captures
+                                 the subfolders holding .bin files
+    '''
+    cam_names = sorted(f[len('metadata_'):-len('.yaml')] for f in os.listdir(save_folder)
+                       if f.startswith('metadata_') and f.endswith('.yaml'))
+    if(cam_names):
+        return(cam_names)
+    return(sorted(f for f in os.listdir(save_folder)
+                  if os.path.isdir(os.path.join(save_folder, f)) and
+                  any(b.endswith('.bin') for b in os.listdir(os.path.join(save_folder, f)))))
+
+# layout assumed for captures recorded before their settings were saved in the session metadata
+DEFAULT_IM_SHAPE = (1544, 2064)
+DEFAULT_IMG_FORMAT = 'XI_RAW8'
+DEFAULT_BAYER_PATTERN = 'GR'
+DEFAULT_IMS_PER_FILE = 200
+
+# colors of the top left 2x2 cell of each Bayer pattern, named by its first row
+BAYER_CELLS = {'GR': ('GR', 'BG'),
+               'RG': ('RG', 'GB'),
+               'BG': ('BG', 'GR'),
+               'GB': ('GB', 'RG')}
+
+def bayer_pattern(pattern, offset_x=0, offset_y=0):
+    '''
+    Bayer pattern of a region of interest starting at (offset_x, offset_y) of a sensor with the given pattern.
+    Odd offsets start the region on a different color.
+    '''
+    rows = BAYER_CELLS[pattern]
+    row = rows[offset_y % 2]
+    return(row[offset_x % 2] + row[(offset_x + 1) % 2])
+
+def bayer_offsets(pattern):
+    '''
+    Where each color sits in the 2x2 cell of a Bayer pattern.
+    Params:
+        pattern (str): Bayer pattern (GR/RG/BG/GB)
+    Returns:
+        offsets (dict): 'r', 'g1' (green on red rows), 'g2', 'b' -> (row, column) within the cell
+    '''
+    offsets = {}
+    for row, colors in enumerate(BAYER_CELLS[pattern]):
+        for col, color in enumerate(colors):
+            if(color == 'G'):
+                offsets['g1' if 'R' in colors else 'g2'] = (row, col)
+            else:
+                offsets[color.lower()] = (row, col)
+    return(offsets)
+
+def read_frame_layout(save_folder, cam_name, im_shape=None, img_format=None):
+    '''
+    How a camera's frames were saved, from the settings snapshot in its session metadata.
+    Values passed in override the metadata, and captures without metadata get the old defaults.
+    Params:
+        save_folder (str): folder the camera's timestamps and metadata are saved in
+        cam_name (str): name of camera (od/os/cy)
+        im_shape (2ple ints): (height, width) of frames, from the metadata if None
+        img_format (str): format frames were saved in, from the metadata if None
+    Returns:
+        layout (dict): im_shape, img_format, bit_depth, bayer_pattern and ims_per_file
+    '''
+    metadata = read_session_metadata(save_folder, cam_name)
+    if(im_shape is None):
+        im_shape = (metadata['height'], metadata['width']) if 'height' in metadata else DEFAULT_IM_SHAPE
+    if(img_format is None):
+        img_format = metadata.get('img_format', DEFAULT_IMG_FORMAT)
+    return({'im_shape': tuple(im_shape),
+            'img_format': img_format,
+            'bit_depth': metadata.get('bit_depth', format_bit_depth(img_format)),
+            'bayer_pattern': metadata.get('bayer_pattern', DEFAULT_BAYER_PATTERN),
+            'ims_per_file': metadata.get('ims_per_file', DEFAULT_IMS_PER_FILE)})
+
+def batch_file_layout(batch_file, im_shape=None, img_format=None):
+    '''
+    read_frame_layout for the camera a batch file belongs to ({save_folder}/{cam}/frames_*.bin).
+    Batch files on striped volumes are found through the pointer each volume keeps to the session
+    folder (see write_metadata_pointer). A folder with neither metadata nor timestamps is a striped
+    volume without a pointer, whose layout cannot be known, so im_shape and img_format must be given.
+    '''
+    cam_folder = os.path.dirname(os.path.abspath(batch_file))
+    save_folder, cam_name = os.path.dirname(cam_folder), os.path.basename(cam_folder)
+    if(im_shape is None or img_format is None):
+        session_files = (metadata_file_name(save_folder, cam_name),
+                         timestamp_index_file_name(save_folder, cam_name),
+                         os.path.join(save_folder, f'timestamps_{cam_name}.tsv'))
+        if not any(os.path.exists(f) for f in session_files):
+            raise ValueError(f'No {cam_name} session metadata or timestamps next to {batch_file}; '
+                             f'read it through its session folder or pass im_shape and img_format')
+    return(read_frame_layout(save_folder, cam_name, im_shape, img_format))
@@ -31,17 +31,18 @@ def run_realsense_aquisition(save_folder, collection_mins, component_name='IMU')
     t2_file_name = os.path.join(save_folder, f"imu_data_{t2sd}.tsv")
 
     with open(t1_file_name, 'w') as t1_file:
-        t1_file.write(f"i\txyz\ttime\n")    
+        t1_file.write(f"i\txyz\ttime\tunix\n")    
     with open(t2_file_name, 'w') as t2_file:
-        t2_file.write(f"i\txyz\ttime\n")
+        t2_file.write(f"i\txyz\ttime\tunix\n")
     
     start_time = time.time()
     i=0
     with open(t1_file_name, 'a+') as t1_file, open(t2_file_name, 'a+') as t2_file:
         while(time.time() - start_time < collection_mins*60):
         
-            t1_file.write(f"{i}\t{t1.get_xyz()}\t{time.monotonic()}\n")
-            t2_file.write(f"{i}\t{t2.get_xyz()}\t{time.monotonic()}\n")
+            #unix time as well so imu samples can be lined up with the cameras
+            t1_file.write(f"{i}\t{t1.get_xyz()}\t{time.monotonic()}\t{time.time()}\n")
+            t2_file.write(f"{i}\t{t2.get_xyz()}\t{time.monotonic()}\t{time.time()}\n")
             
             i+=1
     
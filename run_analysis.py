@@ -1,91 +1,409 @@
 import os
 import numpy as np
 import cv2
-from multiprocessing import Process
+from multiprocessing import Process, Pool
 import re
+import glob
+import shutil
+import subprocess
+import time
 import matplotlib.pyplot as plt
+import capture_format as capfmt
+from collections import OrderedDict
+try:
+    import av
+except ImportError:
+    #without pyav, pupil videos are read through opencv's seeking instead of a keyframe index
+    av = None
 
-def convert_bin_png(filename, save_folder_list, im_shape=(1544,2064), img_format='XI_RAW8'):
+def load_timestamp_table(timestamp_file, cache=True):
     '''
-    Take a file saved in .bin format from a ximea camera, and convert it to a png image.
+    Load a ximea timestamp file as a table of floats.
+    Params:
+        timestamp_file (str): binary timestamps_{cam}.idx index, or a timestamps_{cam}.tsv export
+        cache (bool): save a parsed tsv as a .npy next to it, to load faster next time?
+                      Readers that must not write into the capture folder (eg QC) pass False
+    Returns:
+        ts_table (2d np array): one row per saved frame: collection index, nframe, timestamp (seconds)
+    '''
+    if(timestamp_file.endswith('.idx')):
+        index = capfmt.load_timestamp_index(timestamp_file)
+        return(np.stack((index['index'].astype(np.double),
+                         index['nframe'].astype(np.double),
+                         capfmt.timestamp_index_seconds(index)), axis=1))
+    #parsing a tsv is slow, keep the parsed table next to it until the tsv changes
+    cache_file = timestamp_file + '.npy'
+    if(os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(timestamp_file)):
+        return(np.load(cache_file))
+    with open(timestamp_file, 'r') as f:
+        ts_table=list(zip(line.strip().split('\t') for line in f))
+    ts_table = np.squeeze(np.array(ts_table[1:]).astype(np.double))
+    if(cache):
+        try:
+            np.save(cache_file, ts_table)
+        except OSError:
+            pass
+    return(ts_table)
+
+def ximea_timestamp_file(save_folder, cam_name):
+    '''
+    A camera's timestamp file: the binary timestamps_{cam}.idx index, or timestamps_{cam}.tsv
+    for captures recorded before the index existed.
+    '''
+    index_file = capfmt.timestamp_index_file_name(save_folder, cam_name)
+    if os.path.exists(index_file):
+        return(index_file)
+    return(os.path.join(save_folder, f'timestamps_{cam_name}.tsv'))
+
+class TimestampIndex:
+    '''
+    Timestamps of one recording, loaded once and sorted, answering whole arrays of
+    frame <-> time queries with searchsorted.
+    Use TimestampIndex.load, which keeps one index per file until the file changes.
+    Params:
+        frames (1d np array): frame number of each timestamp (collection index for ximea)
+        timestamps (1d np array): timestamp of each frame
+    '''
+    _cache = {}
+
+    def __init__(self, frames, timestamps):
+        self.frames = np.asarray(frames)
+        self.timestamps = np.asarray(timestamps, dtype=np.double)
+        time_order = np.argsort(self.timestamps, kind='stable')
+        self.sorted_timestamps = self.timestamps[time_order]
+        self.sorted_time_frames = self.frames[time_order]
+        frame_order = np.argsort(self.frames, kind='stable')
+        self.sorted_frames = self.frames[frame_order]
+        self.sorted_frame_timestamps = self.timestamps[frame_order]
+
+    @classmethod
+    def load(cls, timestamp_file):
+        '''
+        Index for a ximea timestamp file (.idx or .tsv) or a pupil timestamps .npy file, cached by mtime.
+        Ximea tables converted by convert_ximea_time_to_unix_and_pl_time are indexed by their
+        timestamps_convert_unix column (unix time), raw timestamp files by the camera clock.
+        '''
+        key = os.path.abspath(timestamp_file)
+        mtime = os.path.getmtime(timestamp_file)
+        if(key in cls._cache and cls._cache[key][0] == mtime):
+            return(cls._cache[key][1])
+        if(timestamp_file.endswith('.npy')):
+            #pupil timestamps, frame number is position in the file
+            timestamps = np.load(timestamp_file)
+            index = cls(np.arange(len(timestamps)), timestamps)
+        else:
+            ts_table = load_timestamp_table(timestamp_file)
+            time_column = 3 if ts_table.shape[1] > 3 else 2
+            index = cls(ts_table[:,0].astype(np.int64), ts_table[:,time_column])
+        cls._cache[key] = (mtime, index)
+        return(index)
+
+    def nearest_frame(self, timestamps):
+        '''
+        Closest frame to each timestamp.
+        Params:
+            timestamps (float or array): timestamps desired
+        Returns:
+            frames (int or array): frame numbers closest to timestamps
+            true_timestamps (float or array): real timestamps of those frames
+        '''
+        timestamps = np.asarray(timestamps, dtype=np.double)
+        n = len(self.sorted_timestamps)
+        right = np.clip(np.searchsorted(self.sorted_timestamps, timestamps), 0, n-1)
+        left = np.clip(right - 1, 0, n-1)
+        use_right = np.abs(self.sorted_timestamps[right] - timestamps) < np.abs(timestamps - self.sorted_timestamps[left])
+        closest = np.where(use_right, right, left)
+        return(self.sorted_time_frames[closest], self.sorted_timestamps[closest])
+
+    def frame_to_time(self, frames):
+        '''
+        Timestamp of each frame.
+        Params:
+            frames (int or array): frame numbers desired
+        Returns:
+            timestamps (float or array): timestamps of those frames
+        '''
+        frames = np.asarray(frames)
+        pos = np.searchsorted(self.sorted_frames, frames)
+        if(np.any(pos >= len(self.sorted_frames)) or
+           np.any(self.sorted_frames[np.minimum(pos, len(self.sorted_frames)-1)] != frames)):
+            raise IndexError('Frame number not in recording')
+        return(self.sorted_frame_timestamps[pos])
+
+def export_timestamp_tsv(index_file, tsv_file):
+    '''
+    Write a binary timestamp index out as the tab separated timestamps file.
+    Params:
+        index_file (str): path to timestamps_{cam}.idx file
+        tsv_file (str): path of tsv file to write
+    '''
+    index = capfmt.load_timestamp_index(index_file)
+    rows = np.stack((index['index'], index['nframe'], index['tsSec'], index['tsUSec']), axis=1)
+    np.savetxt(tsv_file, rows, fmt='%d\t%d\t%d.%06d', header='nframe\ttime', comments='')
+
+def batch_fstart(filename):
+    '''
+    Collection index of the first frame in a batch file, from its name (frames_{start}_{end}.bin or frame_{i}.bin).
+    '''
+    match = re.match(r'frames?_(\d+)', os.path.basename(filename))
+    return(int(match.group(1)) if match else 0)
+
+def bayer_code(pattern='GR'):
+    '''
+    opencv demosaicing code for a Bayer pattern (GR/RG/BG/GB), giving the channel order used throughout this file.
+    '''
+    return(getattr(cv2, f'COLOR_Bayer{pattern}2RGB'))
+
+def convert_bin_png(filename, save_folder, im_shape=None, img_format=None):
+    '''
+    Take a batch file saved in .bin format from a ximea camera, and convert each frame in it to a png image.
     Parameters:
         filename (str): file to be converted
         save_folder (str): folder to save png files
-        im_shape (2pule ints): shape of image
-        img_format (str): Image format files are saved
+        im_shape (2pule ints): shape of image, from the session metadata if None
+        img_format (str): Image format files are saved (XI_RAW8, XI_RAW16 or bit packed PFNC_LSB10/PFNC_LSB12),
+                          from the session metadata if None
     Returns:
         None
     '''
-    
-    fname, _ = os.path.splitext(os.path.basename(filename))
-    save_filepath = os.path.join(save_folder, fname + '.png')
-    binary_img = []
-    
-    if(img_format=='XI_RAW16'):
-        with open(filename, 'rb') as f:
-            bs = f.read(2)
-            while(bs):
-                #for raw_16 img is large and small bytes alternating
-                bs = f.read(1)
-                bs_b = f.read(1)
-                byte = int.from_bytes(bs,'big')
-                byte_big = int.from_bytes(bs_b,'big')
-                #print(256*byte_big+byte)
-                binary_img.append((256*byte_big+byte))
-            f.close()
-    
-        im = np.array(binary_img).reshape(im_shape)
-        im = cv2.cvtColor(np.uint16(im), cv2.COLOR_BayerGR2RGB)
-        im = im.astype(np.uint16)
-        
-    elif(img_format=='XI_RAW8'):
-        with open(filename, 'rb') as f:
-            bs = f.read(1)
-            while(bs):
-                bs = f.read(1)
-                bs = int.from_bytes(bs,'big')
-                binary_img.append(bs)
-            f.close()
-        im = np.array(binary_img).reshape(im_shape)
-        im = cv2.cvtColor(np.uint8(im), cv2.COLOR_BayerGR2RGB)
-        im = im.astype(np.uint8)
-        
-    cv2.imwrite(save_filepath, im)
+    fstart = batch_fstart(filename)
+    layout = capfmt.batch_file_layout(filename, im_shape, img_format)
+    frames = capfmt.read_bin_frames(filename, layout['im_shape'], layout['img_format'])
+    for k, frame in enumerate(frames):
+        im = cv2.cvtColor(frame, bayer_code(layout['bayer_pattern']))
+        if(layout['img_format'] in capfmt.PACKED_FORMATS):
+            #use the full range of the 16 bit png
+            im <<= 16 - layout['bit_depth']
+        cv2.imwrite(os.path.join(save_folder, f'frame_{fstart+k}.png'), im)
     print('*',end='')
     
     return()
 
 
-def bin_to_im(binfile, nframe, dims=(1544,2064),quickread=True):
+def bin_to_im(binfile, nframe, dims=None, quickread=True, img_format=None, bayer_pattern=None):
     '''
-    convert a single image from 8-bit raw bytes to png image.
+    convert a single image from raw bytes to an RGB image.
     Input:
         binfile (str): path to binary file
-        dims (2ple int): What are the dimensions of the iamge?
+        dims (2ple int): What are the dimensions of the iamge? From the session metadata if None
         nframe (int): Which frame number do we want within image?
+        quickread (bool): unused, frames are always read in one call
+        img_format (str): Image format files are saved (XI_RAW8, XI_RAW16 or bit packed PFNC_LSB10/PFNC_LSB12),
+                          from the session metadata if None
+        bayer_pattern (str): Bayer pattern of the frames, from the session metadata if None
         '''
-    # for uint8
-    nbytes = np.prod(dims)
-    startbyte = nframe*nbytes
-    if(quickread):
-        with open(binfile, 'rb') as fn:
-            fn.seek(startbyte+1)
-            im = fn.read(nbytes)
-        im = np.frombuffer(im,dtype='uint8')
-    else:
-        im = []
-        with open(binfile, 'rb') as fn:
-            fn.seek(startbyte)
-            bs = fn.read(1)
-            for i in range(nbytes):
-                bs = fn.read(1)
-                bs = int.from_bytes(bs,'big')
-                im.append(bs)
-            im = np.array(im)
-    im = im.reshape(dims)
-    im = cv2.cvtColor(im, cv2.COLOR_BayerGR2RGB)
+    layout = capfmt.batch_file_layout(binfile, dims, img_format)
+    im = capfmt.read_bin_frames(binfile, layout['im_shape'], layout['img_format'], start=nframe, count=1)[0]
+    im = cv2.cvtColor(im, bayer_code(bayer_pattern or layout['bayer_pattern']))
     return(im)
 
+class FrameStore:
+    '''
+    Random access to every frame one camera saved in a capture, by collection index.
+    Each batch file is memory mapped once, and frames come back as zero-copy numpy views
+    (raw Bayer frames, not demosaiced). Bit packed frames are unpacked to uint16 as they are read.
+        store = FrameStore(scene_cam_folder, 'cy')
+        len(store), store[10], store[100:2000:10], for frame in store: ...
+    Image shape, format and batch size come from the session metadata; pass them in for
+    captures recorded before metadata was saved. Frames are placed by the first collection index
+    of each batch file (from the manifest, or the file name for older captures) and checked against
+    the timestamp index, so a missing or short batch file raises instead of shifting later frames.
+    Params:
+        save_folder (str): folder holding the camera's metadata, manifest and timestamps
+        cam_name (str): name of camera (od/os/cy)
+        volumes (list of str): volume folders to use instead of those recorded in the metadata
+        im_shape (2ple ints): (height, width) of frames, if not in the metadata
+        img_format (str): xiapi image data format, if not in the metadata
+    '''
+    def __init__(self, save_folder, cam_name, volumes=None, im_shape=None, img_format=None):
+        layout = capfmt.read_frame_layout(save_folder, cam_name, im_shape, img_format)
+        self.im_shape = layout['im_shape']
+        self.img_format = layout['img_format']
+        self.bit_depth = layout['bit_depth']
+        self.bayer_pattern = layout['bayer_pattern']
+        self.bayer_code = bayer_code(self.bayer_pattern)
+        self.dtype = capfmt.frame_dtype(self.img_format)
+        self.packed = self.img_format in capfmt.PACKED_FORMATS
+        frame_size = capfmt.frame_nbytes(self.im_shape, self.img_format)
+
+        manifest = capfmt.read_batch_manifest(save_folder, cam_name, volumes)
+        if(manifest is None):
+            #captures without a manifest have all their batch files in one folder
+            cam_folder = os.path.join(save_folder, cam_name)
+            batch_files = sorted((batch_fstart(f), os.path.join(cam_folder, f)) for f in os.listdir(cam_folder) if f.endswith('.bin'))
+        else:
+            batch_files = [manifest[file_id] for file_id in sorted(manifest)]
+
+        self.batches = []
+        starts = []
+        file_starts = {}
+        n_total = 0
+        for k, (fstart, path) in enumerate(batch_files):
+            if(fstart > n_total):
+                raise ValueError(f'{cam_name} batch file {path} starts at frame {fstart}, '
+                                 f'frames {n_total} to {fstart-1} are missing or cut short')
+            if(fstart < n_total):
+                raise ValueError(f'{cam_name} batch file {path} starts at frame {fstart}, '
+                                 f'but the batch files before it hold {n_total} frames')
+            if not os.path.exists(path):
+                raise ValueError(f'{cam_name} batch file {path} is missing')
+            size = os.path.getsize(path)
+            n_frames, extra = divmod(size, frame_size)
+            if(k < len(batch_files) - 1 and extra):
+                raise ValueError(f'{cam_name} batch file {path} is {size} bytes, '
+                                 f'not a whole number of {frame_size} byte frames')
+            elif(extra):
+                #a collection that did not finish cleanly can leave part of a frame at the very end
+                print(f'Ignoring {extra} bytes of partial frame at the end of {path}')
+            file_starts[k if manifest is None else sorted(manifest)[k]] = fstart
+            if(n_frames > 0):
+                if(self.packed):
+                    self.batches.append(np.memmap(path, dtype=np.uint8, mode='r', shape=(n_frames, frame_size)))
+                else:
+                    self.batches.append(np.memmap(path, dtype=self.dtype, mode='r',
+                                                  shape=(n_frames,) + self.im_shape))
+                starts.append(fstart)
+            n_total = fstart + n_frames
+        self.batch_starts = np.array(starts + [n_total], dtype=np.int64)
+        self.luts = {}
+
+        #every timestamp must point at the frame with its collection index
+        index_file = capfmt.timestamp_index_file_name(save_folder, cam_name)
+        if(manifest is not None and os.path.exists(index_file)):
+            index = capfmt.load_timestamp_index(index_file)
+            index = index[index['index'] < n_total]
+            start_of_file = np.full(max(file_starts, default=-1) + 2, -1, dtype=np.int64)
+            start_of_file[list(file_starts)] = list(file_starts.values())
+            file_ids = np.minimum(index['file_id'].astype(np.int64), len(start_of_file) - 1)
+            positions = np.where(start_of_file[file_ids] >= 0,
+                                 start_of_file[file_ids] + index['offset'].astype(np.int64) // frame_size, -1)
+            mismatch = positions != index['index'].astype(np.int64)
+            if np.any(mismatch):
+                bad = int(index['index'][np.argmax(mismatch)])
+                raise ValueError(f'{cam_name} timestamp index and batch files disagree from frame {bad} on')
+
+    def __len__(self):
+        return(int(self.batch_starts[-1]))
+
+    def decode(self, raw):
+        '''
+        Frame(s) from the memory map of a batch, unpacked if they are bit packed.
+        '''
+        if(self.packed):
+            return(capfmt.decode_frames(raw, self.im_shape, self.img_format).reshape(raw.shape[:-1] + self.im_shape))
+        return(raw)
+
+    def locate(self, index):
+        '''
+        Which batch holds a frame, and where within it?
+        Params:
+            index (int): collection index
+        Returns:
+            batch (int): position of the batch in self.batches
+            offset (int): frame number within the batch
+        '''
+        if(index < 0):
+            index += len(self)
+        if not (0 <= index < len(self)):
+            raise IndexError(f'Frame {index} out of range for {len(self)} frames')
+        batch = int(np.searchsorted(self.batch_starts, index, side='right')) - 1
+        return(batch, index - int(self.batch_starts[batch]))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            indices = range(len(self))[key]
+            if(len(indices) == 0):
+                return(np.zeros((0,) + self.im_shape, dtype=self.dtype))
+            first, offset = self.locate(indices[0])
+            last, _ = self.locate(indices[-1])
+            if(first == last):
+                #within one batch file this is a view of the memory map
+                stop = offset + len(indices)*indices.step
+                return(self.decode(self.batches[first][offset:(stop if stop >= 0 else None):indices.step]))
+            return(np.stack([self[i] for i in indices]))
+        batch, offset = self.locate(int(key))
+        return(self.decode(self.batches[batch][offset]))
+
+    def __iter__(self):
+        for batch in self.batches:
+            for raw in batch:
+                yield self.decode(raw)
+
+    def normalize_lut(self, dtype, normalize_max=None):
+        '''
+        Lookup table taking each raw value to min(value/normalize_max, 1), scaled to the full range of integer dtypes.
+        Params:
+            dtype (np dtype): output type
+            normalize_max (float): raw value that maps to 1, 75 for 8 bit frames (scaled up to the bit depth) if None
+        Returns:
+            lut (1d np array): one entry per possible raw value
+        '''
+        if(normalize_max is None):
+            normalize_max = 75 * 2**(self.bit_depth - 8)
+        key = (np.dtype(dtype), normalize_max)
+        if key not in self.luts:
+            lut = np.minimum(np.arange(2**(8*self.dtype.itemsize)) / normalize_max, 1)
+            if(np.issubdtype(dtype, np.integer)):
+                lut = np.round(lut * np.iinfo(dtype).max)
+            self.luts[key] = lut.astype(dtype)
+        return(self.luts[key])
+
+    def scale_lut(self, dtype):
+        '''
+        Lookup table taking each raw value to a narrower integer dtype by dropping its low bits,
+        so bit_depth bit frames fill the output range instead of wrapping around.
+        '''
+        key = (np.dtype(dtype), 'scale')
+        if key not in self.luts:
+            shift = max(self.bit_depth - 8*np.dtype(dtype).itemsize, 0)
+            lut = np.minimum(np.arange(2**(8*self.dtype.itemsize)) >> shift, np.iinfo(dtype).max)
+            self.luts[key] = lut.astype(dtype)
+        return(self.luts[key])
+
+    def get_frames(self, indices, out=None, dtype=np.uint8, normalize=False, normalize_max=None):
+        '''
+        Demosaic many frames into one stacked array.
+        Frames are read in collection order, so each batch file is visited once and front to back, whatever
+        order indices come in. Pass the same out array again to reuse it. Normalization goes through a
+        lookup table (see normalize_lut) straight into out, without float64 temporaries. Without normalization,
+        frames of more bits than an integer out dtype holds are scaled down to it (see scale_lut).
+        Params:
+            indices (list of int): collection indices desired, in any order
+            out (4d np array): (len(indices), height, width, 3) array of dtype to write into, allocated if None
+            dtype (np dtype): output type, eg np.uint8 or np.float32
+            normalize (bool): scale raw values by normalize_max and clip to 1?
+            normalize_max (float): raw value that maps to 1 (see normalize_lut)
+        Returns:
+            frames (4d np array): frames in the order requested, RGB channel order as in bin_to_im
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if(np.any(indices < 0) or np.any(indices >= len(self))):
+            raise IndexError(f'Frame indices out of range for {len(self)} frames')
+        shape = (len(indices),) + self.im_shape + (3,)
+        if(out is None):
+            out = np.empty(shape, dtype=dtype)
+        elif(out.shape != shape or not out.flags['C_CONTIGUOUS']):
+            raise ValueError(f'out must be a contiguous array of shape {shape}')
+        raw_dtype = self.dtype
+        lut = self.normalize_lut(out.dtype, normalize_max) if normalize else None
+        if(lut is None and np.issubdtype(out.dtype, np.integer) and out.dtype.itemsize < raw_dtype.itemsize):
+            lut = self.scale_lut(out.dtype)
+        direct = lut is None and out.dtype == raw_dtype
+        scratch = None if direct else np.empty(self.im_shape + (3,), dtype=raw_dtype)
+        batches = np.searchsorted(self.batch_starts, indices, side='right') - 1
+        for k in np.argsort(indices, kind='stable'):
+            frame = self.decode(self.batches[batches[k]][indices[k] - self.batch_starts[batches[k]]])
+            if(direct):
+                cv2.cvtColor(frame, self.bayer_code, out[k])
+                continue
+            cv2.cvtColor(frame, self.bayer_code, scratch)
+            if(lut is not None):
+                np.take(lut, scratch, out=out[k])
+            else:
+                out[k] = scratch
+        return(out)
+
 def convert_folder(read_folder, write_folder):
     '''
     Convert a folder of raw .bin files to .pngs
@@ -98,6 +416,526 @@ def convert_folder(read_folder, write_folder):
         if f.endswith(".bin"):
             convert_bin_png(os.path.join(read_folder,f), write_folder)
             
+# FrameStores opened by this (worker) process, so each is opened once rather than once per task
+_frame_stores = {}
+
+def open_frame_store(save_folder, cam_name, im_shape=None):
+    '''
+    FrameStore for a camera, cached per process.
+    '''
+    key = (save_folder, cam_name, None if im_shape is None else tuple(im_shape))
+    if key not in _frame_stores:
+        _frame_stores[key] = FrameStore(save_folder, cam_name, im_shape=im_shape)
+    return(_frame_stores[key])
+
+def convert_frames_png(task):
+    '''
+    Convert one chunk of frames to pngs, skipping frames that were already converted.
+    Each png is written to a temporary name and renamed into place, so an interrupted
+    run never leaves a partial png behind.
+    Params:
+        task (tuple): (save_folder, cam_name, start, stop, write_folder) collection index range to convert
+    Returns:
+        cam_name (str): camera converted
+        n_converted (int): frames converted
+        n_skipped (int): frames already converted
+        n_failed (int): frames that could not be converted
+    '''
+    save_folder, cam_name, start, stop, write_folder = task
+    n_converted, n_skipped, n_failed = 0, 0, 0
+    store = open_frame_store(save_folder, cam_name)
+    for i in range(start, stop):
+        png_file = os.path.join(write_folder, f'frame_{i}.png')
+        if os.path.exists(png_file):
+            n_skipped += 1
+            continue
+        try:
+            im = cv2.cvtColor(np.asarray(store[i]), store.bayer_code)
+            if(store.packed):
+                im <<= 16 - store.bit_depth
+            tmp_file = os.path.join(write_folder, f'.frame_{i}.tmp.png')
+            cv2.imwrite(tmp_file, im)
+            os.replace(tmp_file, png_file)
+            n_converted += 1
+        except Exception as e:
+            print(f'Failed to convert {cam_name} frame {i}: {e}')
+            n_failed += 1
+    return(cam_name, n_converted, n_skipped, n_failed)
+
+def convert_capture_parallel(capture_folder, analysis_folder, cam_names=None, chunk_frames=50, n_workers=None):
+    '''
+    Convert every camera's frames in a capture folder to pngs on all cores.
+    Work is split into chunks of frames across all cameras and handed out to a process pool
+    one chunk at a time, so a slow camera never leaves cores idle. Frames already converted
+    are skipped, so an interrupted conversion can be rerun to resume it.
+    Params:
+        capture_folder (str): scene camera capture folder
+        analysis_folder (str): folder to write pngs to, one subfolder per camera
+        cam_names (list of str): cameras to convert, all cameras found in the capture if None
+        chunk_frames (int): frames per unit of work
+        n_workers (int): worker processes, one per core if None
+    Returns:
+        counts (dict): camera name -> (converted, skipped, failed) frame counts
+    '''
+    if(cam_names is None):
+        cam_names = capfmt.find_cameras(capture_folder)
+    tasks = []
+    for cam_name in cam_names:
+        write_folder = os.path.join(analysis_folder, cam_name)
+        if not os.path.exists(write_folder):
+            os.makedirs(write_folder)
+        n_frames = len(FrameStore(capture_folder, cam_name))
+        tasks += [(capture_folder, cam_name, start, min(start + chunk_frames, n_frames), write_folder)
+                  for start in range(0, n_frames, chunk_frames)]
+    n_total = sum(task[3] - task[2] for task in tasks)
+
+    counts = {cam_name: [0, 0, 0] for cam_name in cam_names}
+    print(f'Converting {n_total} frames from {len(cam_names)} cameras in {len(tasks)} chunks...')
+    t_start = time.time()
+    n_done = 0
+    with Pool(n_workers) as pool:
+        for cam_name, n_converted, n_skipped, n_failed in pool.imap_unordered(convert_frames_png, tasks):
+            counts[cam_name][0] += n_converted
+            counts[cam_name][1] += n_skipped
+            counts[cam_name][2] += n_failed
+            n_done += n_converted + n_skipped + n_failed
+            converted = sum(c[0] for c in counts.values())
+            elapsed = time.time() - t_start
+            print(f'\r{n_done}/{n_total} frames ({100*n_done/max(n_total,1):.1f}%), '
+                  f'{converted/elapsed:.1f} frames/s converted', end='')
+    print()
+    print(f'Done with frame conversions in {time.time()-t_start:.1f} seconds.')
+    return({cam_name: tuple(c) for cam_name, c in counts.items()})
+
+def frame_to_rgb8(frame, bit_depth=8, bayer_pattern='GR'):
+    '''
+    Demosaic a raw Bayer frame and scale it to 8 bits for video.
+    Params:
+        frame (2d np array): raw frame
+        bit_depth (int): significant bits per pixel in the raw frame
+        bayer_pattern (str): Bayer pattern of the frame (GR/RG/BG/GB)
+    Returns:
+        im (3d np array): 8 bit BGR image, as opencv writes it
+    '''
+    im = cv2.cvtColor(np.asarray(frame), bayer_code(bayer_pattern))
+    if(im.dtype != np.uint8):
+        im = cv2.convertScaleAbs(im, alpha=255/(2**bit_depth - 1))
+    return(im)
+
+def encode_video_segment(task):
+    '''
+    Encode one range of a camera's frames into a video file.
+    The video is written to a temporary name and renamed into place when finished,
+    and segments that already exist are skipped, so an interrupted export can be rerun.
+    Params:
+        task (tuple): (save_folder, cam_name, start, stop, segment_file, fps, fourcc, bit_depth)
+    Returns:
+        cam_name (str): camera encoded
+        segment_file (str): video written
+        n_frames (int): frames in the segment
+    '''
+    save_folder, cam_name, start, stop, segment_file, fps, fourcc, bit_depth = task
+    if os.path.exists(segment_file):
+        return(cam_name, segment_file, stop - start)
+    store = open_frame_store(save_folder, cam_name)
+    height, width = store.im_shape
+    tmp_file = os.path.join(os.path.dirname(segment_file), '.tmp.' + os.path.basename(segment_file))
+    writer = cv2.VideoWriter(tmp_file, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f'Could not open a {fourcc} video writer for {segment_file}')
+    for i in range(start, stop):
+        writer.write(frame_to_rgb8(store[i], bit_depth, store.bayer_pattern))
+    writer.release()
+    os.replace(tmp_file, segment_file)
+    return(cam_name, segment_file, stop - start)
+
+def concat_video_segments(segment_files, video_file):
+    '''
+    Join video segments into one file without re-encoding (ffmpeg concat demuxer).
+    Without ffmpeg the segments are kept, with an ffconcat playlist at video_file + '.ffconcat' to play them in order.
+    Params:
+        segment_files (list of str): segment videos in order
+        video_file (str): video to write
+    Returns:
+        joined (bool): were the segments joined into video_file?
+    '''
+    list_file = video_file + '.ffconcat'
+    with open(list_file, 'w') as f:
+        f.write('ffconcat version 1.0\n')
+        for segment_file in segment_files:
+            f.write(f"file '{os.path.abspath(segment_file)}'\n")
+    if(shutil.which('ffmpeg') is None):
+        print(f'ffmpeg not found, leaving {len(segment_files)} segments listed in {list_file}')
+        return(False)
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                    '-i', list_file, '-c', 'copy', video_file], check=True)
+    for segment_file in segment_files:
+        os.remove(segment_file)
+    os.remove(list_file)
+    return(True)
+
+def write_video_timestamps(save_folder, cam_name, n_frames, sidecar_file):
+    '''
+    Write which capture frame and timestamp each frame of an exported video comes from.
+    Params:
+        save_folder (str): folder holding the camera's timestamps
+        cam_name (str): name of camera (od/os/cy)
+        n_frames (int): frames in the video
+        sidecar_file (str): tsv to write
+    '''
+    ts_table = load_timestamp_table(ximea_timestamp_file(save_folder, cam_name))[:n_frames]
+    np.savetxt(sidecar_file, np.column_stack((np.arange(len(ts_table)), ts_table)),
+               fmt=['%d', '%d', '%d', '%.6f'], delimiter='\t',
+               header='video_frame\tindex\tnframe\ttime', comments='')
+
+def encode_capture_video(capture_folder, video_folder, cam_names=None, segment_frames=2000, fps=None,
+                         fourcc='mp4v', extension='.mp4', n_workers=None):
+    '''
+    Export every camera's frames in a capture folder to one demosaiced video per camera, instead of pngs.
+    Each camera is split into segments of segment_frames frames that are encoded in parallel on a
+    process pool and joined at the end. A {cam}_timestamps.tsv sidecar maps each video frame to its
+    capture index, camera frame counter and timestamp.
+    Params:
+        capture_folder (str): scene camera capture folder
+        video_folder (str): folder to write videos to
+        cam_names (list of str): cameras to export, all cameras found in the capture if None
+        segment_frames (int): frames per parallel encoding segment
+        fps (float): video frame rate, the capture's median frame rate if None
+        fourcc (str): opencv fourcc code of the video codec
+        extension (str): video file extension matching the codec's container
+        n_workers (int): worker processes, one per core if None
+    Returns:
+        video_files (dict): camera name -> exported video (or ffconcat playlist without ffmpeg)
+    '''
+    if(cam_names is None):
+        cam_names = capfmt.find_cameras(capture_folder)
+    if not os.path.exists(video_folder):
+        os.makedirs(video_folder)
+    tasks = []
+    segments = {}
+    for cam_name in cam_names:
+        store = FrameStore(capture_folder, cam_name)
+        n_frames = len(store)
+        bit_depth = store.bit_depth
+        cam_fps = fps or capfmt.read_session_metadata(capture_folder, cam_name).get('framerate')
+        if(cam_fps is None):
+            ts = load_timestamp_table(ximea_timestamp_file(capture_folder, cam_name))[:,2]
+            cam_fps = 1/np.median(np.diff(ts)) if len(ts) > 1 else 30
+        segments[cam_name] = []
+        for start in range(0, n_frames, segment_frames):
+            segment_file = os.path.join(video_folder, f'{cam_name}_{start}{extension}')
+            segments[cam_name].append(segment_file)
+            tasks.append((capture_folder, cam_name, start, min(start + segment_frames, n_frames),
+                          segment_file, cam_fps, fourcc, bit_depth))
+        write_video_timestamps(capture_folder, cam_name, n_frames,
+                               os.path.join(video_folder, f'{cam_name}_timestamps.tsv'))
+
+    print(f'Encoding {len(cam_names)} cameras in {len(tasks)} segments...')
+    t_start = time.time()
+    n_done = 0
+    with Pool(n_workers) as pool:
+        for cam_name, segment_file, n_frames in pool.imap_unordered(encode_video_segment, tasks):
+            n_done += n_frames
+            print(f'\r{n_done} frames encoded, {n_done/(time.time()-t_start):.1f} frames/s', end='')
+    print()
+
+    video_files = {}
+    for cam_name in cam_names:
+        video_file = os.path.join(video_folder, f'{cam_name}{extension}')
+        joined = concat_video_segments(segments[cam_name], video_file)
+        video_files[cam_name] = video_file if joined else video_file + '.ffconcat'
+    print(f'Done encoding videos in {time.time()-t_start:.1f} seconds.')
+    return(video_files)
+
+PROXY_FACTORS = (2, 4, 8)
+
+def proxy_file_name(proxy_folder, cam_name, factor):
+    return(os.path.join(proxy_folder, f'{cam_name}_proxy_{factor}.npy'))
+
+def bayer_proxies(frames, bit_depth=8, factors=PROXY_FACTORS, bayer_pattern='GR'):
+    '''
+    Downsampled BGR proxies of raw Bayer frames in one vectorized pass.
+    Each 2x2 Bayer cell becomes one pixel (the 1/2 level, greens averaged), and each further
+    level averages 2x2 pixels of the one before.
+    Params:
+        frames (3d np array): raw frames, (n, height, width)
+        bit_depth (int): significant bits per pixel in the raw frames
+        factors (tuple of int): downsampling factors to make, powers of 2 starting at 2
+        bayer_pattern (str): Bayer pattern of the frames (GR/RG/BG/GB)
+    Returns:
+        proxies (dict): factor -> (n, height/factor, width/factor, 3) uint8 BGR frames
+    '''
+    frames = np.asarray(frames)
+    scale = np.float32(255/(2**bit_depth - 1))
+    cell = {color: frames[:,row::2,col::2] for color, (row, col) in capfmt.bayer_offsets(bayer_pattern).items()}
+    green = (cell['g1'].astype(np.float32) + cell['g2']) * (scale/2)
+    level = np.stack((cell['b'] * scale, green, cell['r'] * scale), axis=-1)
+    proxies = {}
+    factor = 2
+    while(factor <= max(factors)):
+        if(factor in factors):
+            proxies[factor] = np.round(level).astype(np.uint8)
+        n, height, width, _ = level.shape
+        level = level[:, :height//2*2, :width//2*2].reshape(n, height//2, 2, width//2, 2, 3).mean(axis=(2,4))
+        factor *= 2
+    return(proxies)
+
+def make_proxy_chunk(task):
+    '''
+    Fill in the proxies for one range of a camera's frames, in the stacks build_proxy_pyramid created.
+    Params:
+        task (tuple): (save_folder, cam_name, start, stop, proxy_folder, bit_depth)
+    Returns:
+        cam_name (str): camera processed
+        n_frames (int): frames processed
+    '''
+    save_folder, cam_name, start, stop, proxy_folder, bit_depth = task
+    store = open_frame_store(save_folder, cam_name)
+    stacks = {factor: np.load(proxy_file_name(proxy_folder, cam_name, factor), mmap_mode='r+') for factor in PROXY_FACTORS}
+    done = np.load(os.path.join(proxy_folder, f'{cam_name}_proxy_done.npy'), mmap_mode='r+')
+    #a few frames at a time keeps the float intermediates small
+    for sub_start in range(start, stop, 8):
+        sub_stop = min(sub_start + 8, stop)
+        for factor, proxy in bayer_proxies(store[sub_start:sub_stop], bit_depth, bayer_pattern=store.bayer_pattern).items():
+            stacks[factor][sub_start:sub_stop] = proxy
+    for stack in stacks.values():
+        stack.flush()
+    done[start:stop] = 1
+    done.flush()
+    return(cam_name, stop - start)
+
+def build_proxy_pyramid(capture_folder, proxy_folder, cam_names=None, chunk_frames=100, n_workers=None):
+    '''
+    Make 1/2, 1/4 and 1/8 resolution BGR proxies of every frame in a capture, on all cores.
+    Each level is stored per camera as one memory-mappable .npy stack ({cam}_proxy_{factor}.npy)
+    indexed by collection index, read back with ProxyPyramid. Chunks already made are skipped,
+    so an interrupted run can be rerun to resume it.
+    Params:
+        capture_folder (str): scene camera capture folder
+        proxy_folder (str): folder to write proxy stacks to
+        cam_names (list of str): cameras to process, all cameras found in the capture if None
+        chunk_frames (int): frames per unit of work
+        n_workers (int): worker processes, one per core if None
+    '''
+    if(cam_names is None):
+        cam_names = capfmt.find_cameras(capture_folder)
+    if not os.path.exists(proxy_folder):
+        os.makedirs(proxy_folder)
+    tasks = []
+    for cam_name in cam_names:
+        store = FrameStore(capture_folder, cam_name)
+        n_frames = len(store)
+        height, width = store.im_shape
+        bit_depth = store.bit_depth
+        done_file = os.path.join(proxy_folder, f'{cam_name}_proxy_done.npy')
+        if os.path.exists(done_file) and len(np.load(done_file, mmap_mode='r')) == n_frames:
+            done = np.load(done_file)
+        else:
+            #start over, creating empty stacks the workers fill in
+            for factor in PROXY_FACTORS:
+                np.lib.format.open_memmap(proxy_file_name(proxy_folder, cam_name, factor), mode='w+', dtype=np.uint8,
+                                          shape=(n_frames, height//factor, width//factor, 3))
+            done = np.lib.format.open_memmap(done_file, mode='w+', dtype=np.uint8, shape=(n_frames,))
+        tasks += [(capture_folder, cam_name, start, min(start + chunk_frames, n_frames), proxy_folder, bit_depth)
+                  for start in range(0, n_frames, chunk_frames)
+                  if not done[start:start + chunk_frames].all()]
+        del done
+
+    print(f'Making proxies in {len(tasks)} chunks...')
+    t_start = time.time()
+    n_done = 0
+    with Pool(n_workers) as pool:
+        for cam_name, n_frames in pool.imap_unordered(make_proxy_chunk, tasks):
+            n_done += n_frames
+            print(f'\r{n_done} frames, {n_done/(time.time()-t_start):.1f} frames/s', end='')
+    print()
+    print(f'Done making proxies in {time.time()-t_start:.1f} seconds.')
+
+class ProxyPyramid:
+    '''
+    Read a camera's proxy stacks made by build_proxy_pyramid, picking the resolution automatically.
+        pyramid = ProxyPyramid(proxy_folder, 'cy')
+        pyramid.frames(range(0, len(pyramid), 100))   #as sharp as fits in budget_bytes
+        pyramid.frames(slice(0, 50), min_width=500)   #smallest level at least 500 pixels wide
+    Params:
+        proxy_folder (str): folder holding the proxy stacks
+        cam_name (str): name of camera (od/os/cy)
+    '''
+    def __init__(self, proxy_folder, cam_name):
+        self.levels = {factor: np.load(proxy_file_name(proxy_folder, cam_name, factor), mmap_mode='r')
+                       for factor in PROXY_FACTORS
+                       if os.path.exists(proxy_file_name(proxy_folder, cam_name, factor))}
+
+    def __len__(self):
+        return(len(next(iter(self.levels.values()))))
+
+    def pick_level(self, n_frames, budget_bytes=256*2**20, min_width=None):
+        '''
+        Downsampling factor to read n_frames at.
+        With min_width, the smallest level at least that wide (or the largest level).
+        Otherwise the sharpest level whose frames fit in budget_bytes (or the smallest level).
+        '''
+        factors = sorted(self.levels)
+        if(min_width is not None):
+            wide_enough = [f for f in factors if self.levels[f].shape[2] >= min_width]
+            return(max(wide_enough) if wide_enough else min(factors))
+        for factor in factors:
+            if(n_frames * np.prod(self.levels[factor].shape[1:]) <= budget_bytes):
+                return(factor)
+        return(max(factors))
+
+    def frames(self, key, factor=None, budget_bytes=256*2**20, min_width=None):
+        '''
+        Params:
+            key (int, slice or list of int): collection indices desired
+            factor (int): downsampling factor, picked with pick_level if None
+        Returns:
+            frames (np array): BGR proxy frame(s)
+            factor (int): downsampling factor used
+        '''
+        if isinstance(key, slice):
+            n_frames = len(range(len(self))[key])
+        else:
+            n_frames = np.size(key)
+        if(factor is None):
+            factor = self.pick_level(n_frames, budget_bytes, min_width)
+        if isinstance(key, range):
+            key = np.asarray(key)
+        return(self.levels[factor][key], factor)
+
+HIST_BINS = 64
+FRAME_STAT_COLUMNS = {'mean': (np.float32, ()),
+                      'mean_r': (np.float32, ()),
+                      'mean_g1': (np.float32, ()),
+                      'mean_g2': (np.float32, ()),
+                      'mean_b': (np.float32, ()),
+                      'saturated': (np.float32, ()),
+                      'sharpness': (np.float32, ()),
+                      'hist': (np.uint32, (HIST_BINS,))}
+
+def frame_stats(frames, bit_depth=8, bayer_pattern='GR'):
+    '''
+    Statistics of each raw Bayer frame, computed for a whole chunk of frames at once.
+    Params:
+        frames (3d np array): raw frames, (n, height, width)
+        bit_depth (int): significant bits per pixel in the raw frames
+        bayer_pattern (str): Bayer pattern of the frames (GR/RG/BG/GB)
+    Returns:
+        stats (dict): column -> array with one row per frame:
+            mean: mean pixel value
+            mean_r, mean_g1, mean_g2, mean_b: mean of each Bayer channel (g1 on red rows)
+            saturated: fraction of pixels at the maximum value
+            sharpness: mean absolute gradient of the green channel, as a fraction of full scale
+            hist: pixel counts in HIST_BINS bins spanning the full scale
+    '''
+    frames = np.asarray(frames)
+    n = len(frames)
+    max_value = 2**bit_depth - 1
+    flat = frames.reshape(n, -1)
+    cell = {color: frames[:,row::2,col::2] for color, (row, col) in capfmt.bayer_offsets(bayer_pattern).items()}
+    stats = {'mean': flat.mean(axis=1, dtype=np.float64),
+             'mean_g1': cell['g1'].mean(axis=(1,2), dtype=np.float64),
+             'mean_r': cell['r'].mean(axis=(1,2), dtype=np.float64),
+             'mean_b': cell['b'].mean(axis=(1,2), dtype=np.float64),
+             'mean_g2': cell['g2'].mean(axis=(1,2), dtype=np.float64),
+             'saturated': (flat >= max_value).mean(axis=1)}
+    green = cell['g1'].astype(np.float32)
+    stats['sharpness'] = (np.abs(np.diff(green, axis=1)).mean(axis=(1,2)) +
+                          np.abs(np.diff(green, axis=2)).mean(axis=(1,2))) / max_value
+    #one bincount for the whole chunk, offsetting each frame's bins
+    #full scale is a power of two, so bins are just the top bits of each pixel
+    bins = (flat >> (bit_depth - int(np.log2(HIST_BINS)))).astype(np.int32)
+    bins += (np.arange(n, dtype=np.int32) * HIST_BINS)[:, None]
+    stats['hist'] = np.bincount(bins.ravel(), minlength=n*HIST_BINS).reshape(n, HIST_BINS)
+    return(stats)
+
+def frame_stats_folder(stats_folder, cam_name):
+    return(os.path.join(stats_folder, f'{cam_name}_frame_stats'))
+
+def compute_stats_chunk(task):
+    '''
+    Fill in the statistics of one range of a camera's frames, in the columns compute_frame_stats created.
+    Params:
+        task (tuple): (save_folder, cam_name, start, stop, stats_folder, bit_depth)
+    Returns:
+        cam_name (str): camera processed
+        n_frames (int): frames processed
+    '''
+    save_folder, cam_name, start, stop, stats_folder, bit_depth = task
+    store = open_frame_store(save_folder, cam_name)
+    column_folder = frame_stats_folder(stats_folder, cam_name)
+    columns = {name: np.load(os.path.join(column_folder, f'{name}.npy'), mmap_mode='r+') for name in FRAME_STAT_COLUMNS}
+    done = np.load(os.path.join(column_folder, 'done.npy'), mmap_mode='r+')
+    for sub_start in range(start, stop, 8):
+        sub_stop = min(sub_start + 8, stop)
+        for name, values in frame_stats(store[sub_start:sub_stop], bit_depth, store.bayer_pattern).items():
+            columns[name][sub_start:sub_stop] = values
+    for column in columns.values():
+        column.flush()
+    done[start:stop] = 1
+    done.flush()
+    return(cam_name, stop - start)
+
+def compute_frame_stats(capture_folder, stats_folder, cam_names=None, chunk_frames=100, n_workers=None):
+    '''
+    Compute frame_stats for every frame in a capture, streaming over the memory mapped batches on all cores.
+    Results are cached per camera as one .npy column per statistic ({cam}_frame_stats/{column}.npy),
+    indexed by collection index and read back with load_frame_stats. Chunks already computed are skipped.
+    Params:
+        capture_folder (str): scene camera capture folder
+        stats_folder (str): folder to write the statistics to
+        cam_names (list of str): cameras to process, all cameras found in the capture if None
+        chunk_frames (int): frames per unit of work
+        n_workers (int): worker processes, one per core if None
+    Returns:
+        stats (dict): camera name -> dict of statistic columns (see load_frame_stats)
+    '''
+    if(cam_names is None):
+        cam_names = capfmt.find_cameras(capture_folder)
+    tasks = []
+    for cam_name in cam_names:
+        store = FrameStore(capture_folder, cam_name)
+        n_frames = len(store)
+        bit_depth = store.bit_depth
+        column_folder = frame_stats_folder(stats_folder, cam_name)
+        done_file = os.path.join(column_folder, 'done.npy')
+        if os.path.exists(done_file) and len(np.load(done_file, mmap_mode='r')) == n_frames:
+            done = np.load(done_file)
+        else:
+            if not os.path.exists(column_folder):
+                os.makedirs(column_folder)
+            for name, (dtype, shape) in FRAME_STAT_COLUMNS.items():
+                np.lib.format.open_memmap(os.path.join(column_folder, f'{name}.npy'), mode='w+',
+                                          dtype=dtype, shape=(n_frames,) + shape)
+            done = np.lib.format.open_memmap(done_file, mode='w+', dtype=np.uint8, shape=(n_frames,))
+        tasks += [(capture_folder, cam_name, start, min(start + chunk_frames, n_frames), stats_folder, bit_depth)
+                  for start in range(0, n_frames, chunk_frames)
+                  if not done[start:start + chunk_frames].all()]
+        del done
+
+    print(f'Computing frame statistics in {len(tasks)} chunks...')
+    t_start = time.time()
+    n_done = 0
+    with Pool(n_workers) as pool:
+        for cam_name, n_frames in pool.imap_unordered(compute_stats_chunk, tasks):
+            n_done += n_frames
+            print(f'\r{n_done} frames, {n_done/(time.time()-t_start):.1f} frames/s', end='')
+    print()
+    print(f'Done computing frame statistics in {time.time()-t_start:.1f} seconds.')
+    return({cam_name: load_frame_stats(stats_folder, cam_name) for cam_name in cam_names})
+
+def load_frame_stats(stats_folder, cam_name):
+    '''
+    Cached frame statistics of a camera (see compute_frame_stats).
+    Params:
+        stats_folder (str): folder the statistics were written to
+        cam_name (str): name of camera (od/os/cy)
+    Returns:
+        stats (dict): column name -> memory mapped array indexed by collection index
+    '''
+    column_folder = frame_stats_folder(stats_folder, cam_name)
+    return({name: np.load(os.path.join(column_folder, f'{name}.npy'), mmap_mode='r') for name in FRAME_STAT_COLUMNS})
+
 def calc_timestamp_stats(timestamp_file, write_folder):
     '''
       Figure out how well we did with timing in terms of capturing images
@@ -175,55 +1013,41 @@ def calc_timestamp_stats(timestamp_file, write_folder):
     plt.savefig(os.path.join(write_folder,'skipped_frames_over_collection.png'))
     plt.show()
     
-def run_ximea_analysis(capture_folder, analysis_folder, timestamp_stats=True, convert_ims=True):
+def run_ximea_analysis(capture_folder, analysis_folder, timestamp_stats=True, convert_ims=True, encode_video=False,
+                       make_proxies=False, compute_stats=False):
     '''
-    Analyze video data, including converting .bin files to png files.
+    Analyze video data, including converting .bin files to png files (or to one video per camera with encode_video).
+    Low resolution proxies for previews (make_proxies) and per frame statistics for exposure QC (compute_stats)
+    read every frame again, so callers opt in to them.
     '''
 
     try:
         
         #calcuate stats on frame capture
         if(timestamp_stats):
-            calc_timestamp_stats(os.path.join(capture_folder,'timestamps.tsv'),
-                                analysis_folder)
+            #collections record their timing statistics while saving, older ones need the combined tsv
+            summary = capfmt.read_timing_summary(capture_folder)
+            if(summary):
+                for cam_name, cam in summary['cameras'].items():
+                    print(f"{cam_name}: {cam['frames']} frames, {cam['dropped']} dropped ({100*cam['drop_rate']:.3f}%), "
+                          f"mean dt {cam['dt'].get('mean', np.nan):.4f} seconds")
+                for pair, disparity in summary['disparity'].items():
+                    print(f"Mean {pair} camera time disparity: {disparity.get('mean', np.nan):.4f} seconds")
+            else:
+                calc_timestamp_stats(os.path.join(capture_folder,'timestamps.tsv'),
+                                    analysis_folder)
         
         if(convert_ims):
- 
-            #OD
-            od_cap_folder = os.path.join(capture_folder,'cam_od')
-            od_ana_folder = os.path.join(analysis_folder,'cam_od')
-            if not os.path.exists(od_ana_folder):
-                os.makedirs(od_ana_folder)    
-            #convert_folder(od_cap_folder, od_ana_folder)
-            od_save_thread = Process(target=convert_folder, args=(od_cap_folder, od_ana_folder))
-            od_save_thread.daemon = True
-            od_save_thread.start()  
-            
-            #OS
-            os_cap_folder = os.path.join(capture_folder,'cam_os')
-            os_ana_folder = os.path.join(analysis_folder,'cam_os')
-            if not os.path.exists(os_ana_folder):
-                os.makedirs(os_ana_folder)
-            #convert_folder(os_cap_folder, os_ana_folder)
-            os_save_thread = Process(target=convert_folder, args=(os_cap_folder, os_ana_folder))
-            os_save_thread.daemon = True
-            os_save_thread.start()  
-
-            #same for CY
-            cy_cap_folder = os.path.join(capture_folder,'cam_cy')
-            cy_ana_folder = os.path.join(analysis_folder,'cam_cy')
-            if not os.path.exists(cy_ana_folder):
-                os.makedirs(cy_ana_folder)
-            #convert_folder(cy_cap_folder, cy_ana_folder)
-            cy_save_thread = Process(target=convert_folder, args=(cy_cap_folder, cy_ana_folder))
-            cy_save_thread.daemon = True
-            cy_save_thread.start() 
-            
-            #wait for all processes to finish
-            print('Waiting for frame conversions...')
-            for proc in [od_save_thread, os_save_thread, cy_save_thread]:
-                proc.join()
-            print('Done with frame conversions.')
+            convert_capture_parallel(capture_folder, analysis_folder)
+
+        if(encode_video):
+            encode_capture_video(capture_folder, analysis_folder)
+
+        if(make_proxies):
+            build_proxy_pyramid(capture_folder, os.path.join(analysis_folder, 'proxies'))
+
+        if(compute_stats):
+            compute_frame_stats(capture_folder, analysis_folder)
             
     except Exception as e:
         print(e)
@@ -269,10 +1093,7 @@ def run_analysis(subject_name=None, task_name=None, exp_type=None,
 
     
 def count_missed_frames(timestamp_file, cam_name):
-    with open(timestamp_file, 'r') as f:
-        ts_table=list(zip(line.strip().split('\t') for line in f))
-    
-    ts_table = np.squeeze(np.array(ts_table[1:]).astype('float'))
+    ts_table = load_timestamp_table(timestamp_file)
     total_frames = ts_table.shape[0]
     nf = ts_table[:,1]
     df = nf[1:] - nf[:-1] - 1
@@ -284,11 +1105,13 @@ def count_missed_frames(timestamp_file, cam_name):
     return(dfp)
     
 
-def plot_camera_timing(timestamp_file, figwrite_file, cam_name):
-    with open(timestamp_file, 'r') as f:
-        ts_table=list(zip(line.strip().split('\t') for line in f))
-    
-    ts_table = np.squeeze(np.array(ts_table[1:]).astype('float'))
+def plot_camera_timing(timestamp_file, figwrite_file, cam_name, show=True, cache=True):
+    '''
+    Plot frame to frame dt of a camera over the collection.
+    Each plot draws on its own figure, so with show=False (eg under the Agg backend) it can run in worker processes.
+    With cache=False a tsv timestamp file is parsed without leaving a cache next to it (see load_timestamp_table).
+    '''
+    ts_table = load_timestamp_table(timestamp_file, cache)
     ts = ts_table[:,2]
     dt = ts[1:] - ts[:-1]
 
@@ -297,114 +1120,141 @@ def plot_camera_timing(timestamp_file, figwrite_file, cam_name):
     mean_dt = np.mean(dt)
     mean_fr = 1/np.mean(dt)
 
-    plt.plot(dt)
-    plt.axhline(med_dt,label=f'median: {med_dt:.5f} = {med_fr:.2f}fps',c='black')
-    plt.axhline(0.005,label='200fps',c='red')
-    plt.axhline(mean_dt,label=f'mean: {mean_dt:.5f} = {mean_fr:.2f}fps',c='green')
-    plt.plot(dt, label='sample', c='blue')
-    plt.ylabel('dt')
-    plt.legend()
-    plt.title(f'{cam_name} Camera Timing')
-    plt.savefig(figwrite_file)
-    plt.show()
-    
-def plot_camera_dframe(timestamp_file, figwrite_file, cam_name):
-    with open(timestamp_file, 'r') as f:
-        ts_table=list(zip(line.strip().split('\t') for line in f))
+    fig, ax = plt.subplots()
+    ax.axhline(med_dt,label=f'median: {med_dt:.5f} = {med_fr:.2f}fps',c='black')
+    ax.axhline(0.005,label='200fps',c='red')
+    ax.axhline(mean_dt,label=f'mean: {mean_dt:.5f} = {mean_fr:.2f}fps',c='green')
+    ax.plot(dt, label='sample', c='blue')
+    ax.set_ylabel('dt')
+    ax.legend()
+    ax.set_title(f'{cam_name} Camera Timing')
+    fig.savefig(figwrite_file)
+    if(show):
+        plt.show()
+    else:
+        plt.close(fig)
     
-    ts_table = np.squeeze(np.array(ts_table[1:]).astype('float'))
+def plot_camera_dframe(timestamp_file, figwrite_file, cam_name, show=True, cache=True):
+    '''
+    Plot the camera frame counter step between saved frames over the collection (1 when no frames are missed).
+    '''
+    ts_table = load_timestamp_table(timestamp_file, cache)
     ts = ts_table[:,1]
     dt = ts[1:] - ts[:-1]
 
     med_dt = np.median(dt)
     mean_dt = np.mean(dt)
     
+    fig, ax = plt.subplots()
+    ax.axhline(1,label='All Frames Kept',c='red')
+    ax.axhline(med_dt,label=f'median: {med_dt:.5f}',c='black')
+    ax.axhline(mean_dt,label=f'mean: {mean_dt:.5f}',c='green')
+    ax.plot(dt, label='sample', c='blue')
+    ax.set_ylabel('dframe')
+    ax.legend()
+    ax.set_title(f'{cam_name} Camera Dframes')
+    fig.savefig(figwrite_file)
+    if(show):
+        plt.show()
+    else:
+        plt.close(fig)
 
-    plt.plot(dt)
-    plt.axhline(1,label='All Frames Kept',c='red')
-    plt.axhline(med_dt,label=f'median: {med_dt:.5f}',c='black')
-    plt.axhline(mean_dt,label=f'mean: {mean_dt:.5f}',c='green')
-    plt.plot(dt, label='sample', c='blue')
-    plt.ylabel('dframe')
-    plt.legend()
-    plt.title(f'{cam_name} Camera Dframes')
-    plt.savefig(figwrite_file)
-    plt.show()
+def plot_camera_drops(timestamp_file, figwrite_file, cam_name, show=True, cache=True):
+    '''
+    Plot the running total of missed camera frames against time in the collection.
+    '''
+    ts_table = load_timestamp_table(timestamp_file, cache)
+    missed = np.cumsum(np.maximum(np.diff(ts_table[:,1]) - 1, 0))
+    t = ts_table[1:,2] - ts_table[0,2]
+
+    fig, ax = plt.subplots()
+    ax.plot(t, missed, c='blue')
+    ax.set_xlabel('seconds')
+    ax.set_ylabel('missed frames (total)')
+    ax.set_title(f'{cam_name} Camera Dropped Frames: {int(missed[-1]) if len(missed) else 0}')
+    fig.savefig(figwrite_file)
+    if(show):
+        plt.show()
+    else:
+        plt.close(fig)
     
 def ximea_timestamp_to_framenum(timestamp_file, timestamp):
     '''
     Given a unix timestamp, what is the closest frame from a ximea camera recording?
     Params:
-        timestamp_file (str): path to a timestamp file for this camera
-        timestamp (float): timestamp desired.
+        timestamp_file (str): path to a converted timestamp table for this camera (see convert_ximea_time_to_unix_and_pl_time),
+                              raw timestamp files (.idx or .tsv) are looked up by camera clock instead
+        timestamp (float or array): timestamp(s) desired.
     Returns:
-        i (int): frame number of collection *NOT NFRAME CAMERA COUNTER*) closest to timestamp
-        true_timestamp (float): What is the real timestamp of this frame?
+        i (int or array): frame number of collection *NOT NFRAME CAMERA COUNTER*) closest to timestamp
+        true_timestamp (float or array): What is the real timestamp of this frame?
     '''
-    with open(timestamp_file, 'r') as f:
-        ts_table=list(zip(line.strip().split('\t') for line in f))
-    
-    ts_table = np.squeeze(np.array(ts_table[1:]).astype('float'))
-    closest_idx = np.argmin(np.abs(ts_table[:,3]-timestamp))
-    i = int(ts_table[closest_idx,0])
-    true_timestamp = ts_table[closest_idx,3]
+    i, true_timestamp = TimestampIndex.load(timestamp_file).nearest_frame(timestamp)
     return(i, true_timestamp)
     
 def ximea_framenum_to_timestamp(timestamp_file, framenum):
     '''
-    Given a unix timestamp, what is the closest frame from a ximea camera recording?
+    Given a frame number, what is its unix timestamp in a ximea camera recording?
     Params:
-        timestamp_file (str): path to a timestamp file for this camera
-        framenum (int): framenum desired ***THIS IS NOT NFRAME CAMERA COUNTER but counter with respect to collection******.
+        timestamp_file (str): path to a converted timestamp table for this camera (see convert_ximea_time_to_unix_and_pl_time),
+                              raw timestamp files (.idx or .tsv) give camera clock times instead
+        framenum (int or array): framenum desired ***THIS IS NOT NFRAME CAMERA COUNTER but counter with respect to collection******.
     Returns:
-        ts (float): timestamp of framenum frame
+        ts (float or array): timestamp of framenum frame
     '''
     
-    with open(timestamp_file, 'r') as f:
-        ts_table=list(zip(line.strip().split('\t') for line in f))
-    
-    ts_table = np.squeeze(np.array(ts_table[1:]).astype('float'))
-    ts = np.float(ts_table[np.where(ts_table[:,0]==framenum),3])
+    ts = TimestampIndex.load(timestamp_file).frame_to_time(framenum)
     return(ts)
 
-def ximea_get_frame(frame_number, save_batchsize, cam_name, cam_save_folder, img_dims=(1544,2064), normalize=True):
+def ximea_get_frame(frame_number, save_batchsize, cam_name, cam_save_folder, img_dims=None, normalize=True):
     '''
-    Get the filename and offset of a given frame number from the camera.
+    Get a given frame number from the camera, demosaiced.
+    Reads go through the camera's FrameStore, opened once per process, so calling this in a loop
+    does not re-read the session metadata and manifest for every frame.
     Params:
         frame_number (int): number of frame desired
-        save_bathsize (int): what was the batchsize during collection?
+        save_bathsize (int): unused, batch files are located through the manifest or their names
         cam_name (str): what is the name of the caera? OD/OS/CY
         cam_save_folder (str): what is the name of the folder?
-        img_dims (int, int): dimensions of frame reading in.
+        img_dims (int, int): dimensions of frame reading in, from the session metadata if None
     Returns:
         frame (2d numpy array): 2d array of frame from saved file
     '''
     
-    file_start = int(np.floor(frame_number/save_batchsize)*save_batchsize)
-    file_end = file_start + save_batchsize - 1
-    frame_offset = frame_number%file_start if file_start>0 else frame_number
-    file_name = f'frames_{file_start}_{file_end}.bin'
-    file_path = os.path.join(cam_save_folder, cam_name, file_name)
-    
-    frame = bin_to_im(file_path, frame_offset, img_dims)
+    store = open_frame_store(cam_save_folder, cam_name, img_dims)
+    frame = cv2.cvtColor(np.asarray(store[frame_number]), store.bayer_code)
     
     if normalize:
-        frame = frame/75
+        frame = frame/(75 * 2**(store.bit_depth - 8))
         frame[frame > 1] = 1
         
     return(frame)
 
+def ximea_get_frames(indices, cam_name, cam_save_folder, out=None, dtype=np.uint8, normalize=False):
+    '''
+    Get many demosaiced frames from a camera at once (see FrameStore.get_frames).
+    Params:
+        indices (list of int): collection indices of the frames desired
+        cam_name (str): what is the name of the caera? OD/OS/CY
+        cam_save_folder (str): what is the name of the folder?
+        out (4d np array): array to reuse for the frames, allocated if None
+        dtype (np dtype): output type
+        normalize (bool): normalize as ximea_get_frame does (divide by 75, clip to 1), scaled to dtype
+    Returns:
+        frames (4d numpy array): (n, height, width, 3) frames
+    '''
+    return(open_frame_store(cam_save_folder, cam_name).get_frames(indices, out, dtype, normalize))
+
 def pupil_framenum_to_timestamp(timestamp_file, framenum):
     '''
     Given a unix timestamp, what is the closest frame from a pupil camera recording?
     Params:
         timestamp_file (str): path to a timestamp file for this camera
-        framenum (int): framenum desired
+        framenum (int or array): framenum desired
     Returns:
-        ts (float): timestamp of framenum frame
+        ts (float or array): timestamp of framenum frame
     '''
-    timestamp_list = np.load(timestamp_file)
-    ts = timestamp_list[framenum]
+    ts = TimestampIndex.load(timestamp_file).frame_to_time(framenum)
     return(ts)
 
 def pupil_timestamp_to_framenum(timestamp_file, timestamp):
@@ -412,28 +1262,153 @@ def pupil_timestamp_to_framenum(timestamp_file, timestamp):
     Given a unix timestamp, what is the closest frame from a pupil camera recording?
     Params:
         timestamp_file (str): path to a timestamp file for this camera
-        timestamp (float): timestamp desired.
+        timestamp (float or array): timestamp(s) desired.
     Returns:
-        i (int): frame number of collection *NOT NFRAME CAMERA COUNTER*) closest to timestamp
-        true_timestamp (float): What is the real timestamp of this frame?
+        i (int or array): frame number of collection *NOT NFRAME CAMERA COUNTER*) closest to timestamp
+        true_timestamp (float or array): What is the real timestamp of this frame?
     '''
-    timestamp_list = np.load(timestamp_file)
-    i = np.argmin(np.abs(timestamp_list-timestamp))
-    true_timestamp = timestamp_list[i]
+    i, true_timestamp = TimestampIndex.load(timestamp_file).nearest_frame(timestamp)
 
     return(i, true_timestamp)
 
+class PupilVideo:
+    '''
+    Random access to the frames of a pupil labs eye/world video.
+    On first use the packets are scanned (without decoding) for their timestamps and keyframes,
+    and this index is saved next to the video as .idx.npz until the video changes. A frame is
+    read by seeking to the keyframe before it and decoding forward; reads that move forward
+    past no keyframe just keep decoding. Recently decoded frames are kept in an LRU cache.
+    Without pyav, opencv's frame seeking is used instead.
+    Params:
+        video_file (str): path to the video file
+        cache_frames (int): how many decoded frames to keep
+    '''
+    def __init__(self, video_file, cache_frames=256):
+        self.video_file = video_file
+        self.cache_frames = cache_frames
+        self.cache = OrderedDict()
+        self.position = None
+        if(av is not None):
+            self.pts, self.keyframes = self._load_index()
+            self.container = av.open(video_file)
+            self.stream = self.container.streams.video[0]
+            self.decoder = None
+        else:
+            self.vidcap = cv2.VideoCapture(video_file)
+            self.pts = np.arange(int(self.vidcap.get(cv2.CAP_PROP_FRAME_COUNT)))
+
+    def _load_index(self):
+        '''
+        Sorted presentation timestamps of every frame and the frame numbers of the keyframes.
+        '''
+        index_file = self.video_file + '.idx.npz'
+        if(os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(self.video_file)):
+            with np.load(index_file) as index:
+                return(index['pts'], index['keyframes'])
+        pts = []
+        keyframe_pts = []
+        with av.open(self.video_file) as container:
+            stream = container.streams.video[0]
+            for packet in container.demux(stream):
+                if(packet.pts is None):
+                    continue
+                pts.append(packet.pts)
+                if(packet.is_keyframe):
+                    keyframe_pts.append(packet.pts)
+        pts = np.sort(np.array(pts, dtype=np.int64))
+        keyframes = np.searchsorted(pts, np.array(keyframe_pts, dtype=np.int64))
+        if(len(keyframes) == 0 or keyframes[0] != 0):
+            keyframes = np.union1d([0], keyframes)
+        try:
+            np.savez(index_file, pts=pts, keyframes=keyframes)
+        except OSError:
+            pass
+        return(pts, keyframes)
+
+    def __len__(self):
+        return(len(self.pts))
+
+    def _decode_av(self, framenum):
+        keyframe = self.keyframes[np.searchsorted(self.keyframes, framenum, side='right') - 1]
+        #seek only if the frame is behind us or past a keyframe we would otherwise decode up to
+        if(self.position is None or framenum < self.position or keyframe > self.position):
+            self.container.seek(int(self.pts[keyframe]), stream=self.stream, backward=True, any_frame=False)
+            self.decoder = self.container.decode(self.stream)
+        for frame in self.decoder:
+            if(frame.pts is None):
+                continue
+            self.position = int(np.searchsorted(self.pts, frame.pts)) + 1
+            if(frame.pts >= self.pts[framenum]):
+                return(frame.to_ndarray(format='bgr24'))
+        self.position = None
+        raise IndexError(f'Failed to get frame number {framenum}')
+
+    def _decode_cv2(self, framenum):
+        if(self.position != framenum):
+            self.vidcap.set(cv2.CAP_PROP_POS_FRAMES, framenum)
+        success, frame = self.vidcap.read()
+        if not success:
+            self.position = None
+            raise IndexError(f'Failed to get frame number {framenum}')
+        self.position = framenum + 1
+        return(frame)
+
+    def get_frame(self, framenum):
+        '''
+        Params:
+            framenum (int): frame number desired
+        Returns:
+            frame (3d np array): BGR frame, as opencv reads it
+        '''
+        framenum = int(framenum)
+        if(framenum < 0):
+            framenum += len(self)
+        if(framenum in self.cache):
+            self.cache.move_to_end(framenum)
+            return(self.cache[framenum])
+        if(framenum < 0 or framenum >= len(self)):
+            raise IndexError(f'Frame {framenum} out of range for video with {len(self)} frames')
+        frame = self._decode_av(framenum) if(av is not None) else self._decode_cv2(framenum)
+        self.cache[framenum] = frame
+        if(len(self.cache) > self.cache_frames):
+            self.cache.popitem(last=False)
+        return(frame)
+
+    def get_frames(self, framenums):
+        '''
+        Read many frames, decoding them in increasing order so each keyframe is visited at most once.
+        Params:
+            framenums (list of int): frame numbers desired, in any order
+        Returns:
+            frames (4d np array): frames in the order requested
+        '''
+        framenums = np.asarray(framenums, dtype=np.int64)
+        frames = {framenum: self.get_frame(framenum) for framenum in np.unique(framenums)}
+        return(np.stack([frames[framenum] for framenum in framenums]))
+
+    def close(self):
+        if(av is not None):
+            self.container.close()
+        else:
+            self.vidcap.release()
+
+_pupil_videos = {}
+
+def open_pupil_video(video_file):
+    '''
+    Shared PupilVideo for a video file, so repeated lookups reuse its index, decoder and cache.
+    '''
+    key = os.path.abspath(video_file)
+    if(key not in _pupil_videos):
+        _pupil_videos[key] = PupilVideo(video_file)
+    return(_pupil_videos[key])
+
 def pupl_get_framemeans(video_file, frame_start, nframes):
     '''
     Caclualte the framemeans for a set of frames in sucession
     '''
-    vidcap = cv2.VideoCapture(video_file)
-    means = []
-    for i in range(frame_start):
-        success, frame = vidcap.read()
-    for i in range(frame_start, frame_start+nframes):
-        success, frame = vidcap.read()
-        means.append(np.mean(frame))
+    video = open_pupil_video(video_file)
+    means = [np.mean(video.get_frame(i)) for i in range(frame_start, frame_start+nframes)]
     
     return(means)
 
@@ -447,71 +1422,53 @@ def pupil_get_frame(video_file, framenum, normalize=False):
     Returns:
         frame (2d array): image from pupil camera
     '''
-    vidcap = cv2.VideoCapture(video_file)
-    for i in range(framenum+1):
-        success, frame = vidcap.read()
-    if(success):
-        if(normalize):
-            frame = 255*(frame/np.max(image))
-        return(frame)
-    else:
+    try:
+        frame = open_pupil_video(video_file).get_frame(framenum)
+    except IndexError:
         print(f'Failed to get frame number {framenum}')
         return(0)
+    if(normalize):
+        frame = 255*(frame/np.max(frame))
+    return(frame)
 
-def convert_ximea_time_to_unix_and_pl_time(timestamp_file, sync_file):
+def convert_ximea_time_to_unix_and_pl_time(timestamp_file, sync_file, pupil_sync_file=None, segment_seconds=60):
     '''
     Convert the ximea camera times to unix and pupil labs timestamps
     Params:
         timestamp_file (str): path to .csv file with ximea timesstamps
         sync_file (str): path to .csv file with sync information
+        pupil_sync_file (str): path to timestamp_camsync_pupil.tsv, if pupil time was sampled during collection.
+                               Without it pupil time is taken to be unix time (pupil capture is synced to time.time)
+        segment_seconds (float): knot spacing of the drift fits
     Returns:
         unix_timestamp_array (2d np array): Unix Timestamps and pupil labs timestamps Inferred
     '''
-    with open(timestamp_file, 'r') as f:
-        ts_table=list(zip(line.strip().split('\t') for line in f))
-    ts_table = np.squeeze(np.array(ts_table[1:]).astype(np.double))
-
-    with open(sync_file, 'r') as f:
-        sync_table=list(zip(line.strip().split('\t') for line in f))
-            
-    (plsync_pre, cam_pre, unix_pre) = np.array(sync_table[1][0][1:]).astype(np.double)
-    (plsync_post, cam_post, unix_post) = np.array(sync_table[2][0][1:]).astype(np.double)
+    ts_table = load_timestamp_table(timestamp_file)
+    t_wall, t_cam = load_camsync_table(sync_file)
 
     #how far off have the computer and camera timestamps drifted?
-    t_elapsed_pl = np.double(plsync_post) - np.double(plsync_pre)
-    t_elapsed_unix = np.double(unix_post) - np.double(unix_pre)
-    t_elapsed_cam = np.double(cam_post) - np.double(cam_pre)
-    drift_cm_pl = np.abs(t_elapsed_pl - t_elapsed_cam)
-    drift_cm_ux = np.abs(t_elapsed_unix - t_elapsed_cam)
-    drift_pl_ux = np.abs(t_elapsed_unix - t_elapsed_pl)
+    t_elapsed_unix = t_wall[-1] - t_wall[0]
+    t_elapsed_cam = t_cam[-1] - t_cam[0]
     print(f'Time Elapsed Cam: {t_elapsed_cam} seconds')
-    print(f'Time Elapsed Pupil: {t_elapsed_pl} seconds')
     print(f'Time Elapsed Unix: {t_elapsed_unix} seconds')
-    print(f'Time Drift cam vs pupil: {drift_cm_pl} seconds')
-    print(f'Time Drift cam vs unix: {drift_cm_ux} seconds')
-    print(f'Time Drift unix vs pupil: {drift_pl_ux} seconds')
-
-    # We assume here that time.time() in Linux's 0.001s precision is better than camera's.
-    # Convert Camera timestamps to Unix timestamps.
-#     #first convert to [0,1]
-    #timestamps_unix = (ts_table[:,1] - cam_pre) / (cam_post - cam_pre)
-    #timestamps_plsync = (ts_table[:,2] - cam_pre) / (cam_post - cam_pre)
-#     #then convert to wall time
-    #timestamps_unix = (timestamps_unix * (unix_post - unix_pre)) + unix_pre
-    #timestamps_plsync = (timestamps_plsync * (unix_post - unix_pre)) + plsync_pre
-
-    #calculate offset from camera and two timekeeping methods
-    d_xim_to_pup = plsync_pre - cam_pre
-    #d_xim_to_pup = np.mean((plsync_pre - cam_pre, plsync_post - cam_post))
-    timestamps_plsync = ts_table[:,2] + d_xim_to_pup
-    
-    d_xim_to_unix = unix_pre - cam_pre
-    #d_xim_to_unix = np.mean((unix_pre - cam_pre, unix_post - cam_post))
-    timestamps_unix = ts_table[:,2] + d_xim_to_unix
-    
+    print(f'Time Drift cam vs unix: {np.abs(t_elapsed_unix - t_elapsed_cam)} seconds')
+
+    #convert with a drift model fit over every sync sample, not just the offset at the start
+    cam_to_unix = fit_clock_model(t_cam, t_wall, segment_seconds=segment_seconds)
+    timestamps_unix = cam_to_unix(ts_table[:,2])
+    print(f'Sync residual cam vs unix: {np.max(np.abs(cam_to_unix(t_cam) - t_wall)[cam_to_unix.inliers])} seconds, '
+          f'{np.sum(~cam_to_unix.inliers)} of {len(t_cam)} sync samples rejected')
+
+    if(pupil_sync_file is not None):
+        t_wall_pupil, t_pupil = load_camsync_table(pupil_sync_file)
+        unix_to_pupil = fit_clock_model(t_wall_pupil, t_pupil, segment_seconds=segment_seconds)
+        timestamps_plsync = unix_to_pupil(timestamps_unix)
+        print(f'Time Drift unix vs pupil: {np.abs((t_pupil[-1] - t_pupil[0]) - (t_wall_pupil[-1] - t_wall_pupil[0]))} seconds, '
+              f'{np.sum(~unix_to_pupil.inliers)} of {len(t_pupil)} pupil sync samples rejected')
+    else:
+        timestamps_plsync = timestamps_unix.copy()
     
     timestamps_unix_adjusted = timestamps_unix - (timestamps_unix[0]-timestamps_plsync[0])
-    #print(timestamps_unix[0], timestamps_plsync[0], timestamps_unix_adjusted[0])
     
     #add unix time to data table
     t_cam_converted = np.append(ts_table, np.expand_dims(timestamps_unix,1),axis=1)
@@ -522,3 +1479,236 @@ def convert_ximea_time_to_unix_and_pl_time(timestamp_file, sync_file):
     
     return(t_cam_converted, table_cols)
 
+
+class ClockModel:
+    '''
+    Continuous piecewise-linear map from one clock to another, fit by fit_clock_model.
+    Calling it converts a whole array of times at once, extrapolating the end segments linearly.
+    Params:
+        knots (1d np array): source clock times where the slope may change
+        offset (float): constant part of (reference - source)
+        coefs (1d np array): (reference - source - offset) at each knot
+        inliers (1d bool np array): which sync pairs the fit kept, None if unknown
+    '''
+    def __init__(self, knots, offset, coefs, inliers=None):
+        self.knots = np.asarray(knots, dtype=np.double)
+        self.offset = offset
+        self.coefs = np.asarray(coefs, dtype=np.double)
+        self.inliers = inliers
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=np.double)
+        return(t + self.offset + self.drift(t))
+
+    def drift(self, t):
+        '''
+        Varying part of (reference - source) at source times t, without the constant offset.
+        '''
+        t = np.asarray(t, dtype=np.double)
+        knots, coefs = self.knots, self.coefs
+        drift = np.interp(t, knots, coefs)
+        if(len(knots) > 1):
+            #np.interp holds the end values, continue the end segments linearly instead
+            slope_start = (coefs[1] - coefs[0]) / (knots[1] - knots[0])
+            slope_end = (coefs[-1] - coefs[-2]) / (knots[-1] - knots[-2])
+            drift += np.minimum(t - knots[0], 0) * slope_start + np.maximum(t - knots[-1], 0) * slope_end
+        return(drift)
+
+def _knot_basis(t, knots):
+    '''
+    Linear interpolation weights of t between knots (hat functions), one column per knot.
+    '''
+    t = np.atleast_1d(t)
+    basis = np.zeros((len(t), len(knots)))
+    if(len(knots) == 1):
+        basis[:,0] = 1
+        return(basis)
+    seg = np.clip(np.searchsorted(knots, t, side='right') - 1, 0, len(knots)-2)
+    w = (t - knots[seg]) / (knots[seg+1] - knots[seg])
+    rows = np.arange(len(t))
+    basis[rows, seg] = 1 - w
+    basis[rows, seg+1] = w
+    return(basis)
+
+def fit_clock_model(t_source, t_reference, segment_seconds=60, n_sigma=3, min_tolerance=1e-4, max_iter=10):
+    '''
+    Robust fit of a clock map from sync sample pairs. A continuous piecewise-linear curve
+    (knots every segment_seconds, fewer if samples are sparse) is fit by least squares, pairs
+    further than n_sigma robust standard deviations from it (eg a sample delayed by the scheduler)
+    are rejected and the fit is repeated until no more pairs are rejected.
+    Params:
+        t_source (1d np array): times on the clock to convert from (eg camera time)
+        t_reference (1d np array): matching times on the clock to convert to (eg unix time)
+        segment_seconds (float): spacing between knots, None for a single line
+        n_sigma (float): rejection threshold in robust standard deviations
+        min_tolerance (float): never reject pairs closer than this many seconds to the fit
+        max_iter (int): maximum number of reject and refit rounds
+    Returns:
+        model (ClockModel): callable converting source times to reference times, with the pairs kept in model.inliers
+    '''
+    t_source = np.asarray(t_source, dtype=np.double)
+    t_reference = np.asarray(t_reference, dtype=np.double)
+    #fit the small difference between clocks, not the large absolute times
+    diff = t_reference - t_source
+    offset = np.median(diff)
+    diff = diff - offset
+    inliers = np.ones(len(t_source), dtype=bool)
+    for _ in range(max_iter):
+        t_in = t_source[inliers]
+        span = t_in.max() - t_in.min()
+        n_segments = 1 if(segment_seconds is None) else int(np.ceil(span / segment_seconds))
+        #keep at least two samples per segment
+        n_segments = max(min(n_segments, len(t_in)//2 - 1), 1)
+        knots = np.linspace(t_in.min(), t_in.max(), n_segments+1) if(span > 0) else t_in[:1]
+        coefs = np.linalg.lstsq(_knot_basis(t_in, knots), diff[inliers], rcond=None)[0]
+        residual = diff - ClockModel(knots, 0, coefs).drift(t_source)
+        mad = np.median(np.abs(residual[inliers] - np.median(residual[inliers]))) * 1.4826
+        new_inliers = np.abs(residual) <= max(n_sigma*mad, min_tolerance)
+        if(np.array_equal(new_inliers, inliers) or new_inliers.sum() < 2):
+            break
+        inliers = new_inliers
+    return(ClockModel(knots, offset, coefs, inliers))
+
+def load_camsync_table(sync_file):
+    '''
+    Read the camera/wall clock pairs written during a ximea collection.
+    Params:
+        sync_file (str): path to timestamp_camsync_{cam}.tsv
+    Returns:
+        t_wall (1d np array): unix time of each sample
+        t_cam (1d np array): camera time of each sample
+    '''
+    sync_table = np.loadtxt(sync_file, delimiter='\t', skiprows=1, usecols=(1,2), ndmin=2)
+    return(sync_table[:,0], sync_table[:,1])
+
+def ximea_unix_timestamps(timestamp_file, sync_file, segment_seconds=60):
+    '''
+    Timestamps of a ximea recording converted from the camera clock to unix time,
+    with a robust drift fit through the camera/wall clock pairs in the sync file (see fit_clock_model).
+    Params:
+        timestamp_file (str): path to a timestamp file for this camera
+        sync_file (str): path to timestamp_camsync_{cam}.tsv for this camera
+        segment_seconds (float): knot spacing of the drift fit
+    Returns:
+        frames (1d np array): frame number of collection for each timestamp
+        timestamps_unix (1d np array): unix time of each frame
+    '''
+    ts_table = load_timestamp_table(timestamp_file)
+    t_wall, t_cam = load_camsync_table(sync_file)
+    cam_to_unix = fit_clock_model(t_cam, t_wall, segment_seconds=segment_seconds)
+    return(ts_table[:,0].astype(np.int64), cam_to_unix(ts_table[:,2]))
+
+def realsense_unix_timestamps(imu_file):
+    '''
+    Sample numbers and unix times from a realsense IMU log.
+    Params:
+        imu_file (str): path to an imu_data_{serial}.tsv file
+    Returns:
+        samples (1d np array): sample number of each row
+        timestamps_unix (1d np array): unix time of each sample
+    '''
+    with open(imu_file, 'r') as f:
+        header = f.readline().strip().split('\t')
+    if('unix' not in header):
+        raise ValueError(f'{imu_file} has no unix time column, it can not be lined up with other streams')
+    imu_table = np.loadtxt(imu_file, delimiter='\t', skiprows=1, ndmin=2,
+                           usecols=(header.index('i'), header.index('unix')))
+    return(imu_table[:,0].astype(np.int64), imu_table[:,1])
+
+def load_session_streams(session_folder):
+    '''
+    Find every stream of a collection and put its timestamps in unix time.
+    Looks for ximea cameras in scene_camera, pupil labs *_timestamps.npy files in eye_camera
+    (pupil capture is synced to time.time, drift corrected with timestamp_camsync_pupil.tsv if present),
+    and realsense logs in imu.
+    Params:
+        session_folder (str): folder of one collection (holding scene_camera, eye_camera, imu)
+    Returns:
+        streams (dict): stream name -> (frame numbers, unix timestamps)
+    '''
+    streams = {}
+    scene_folder = os.path.join(session_folder, 'scene_camera')
+    if(os.path.isdir(scene_folder)):
+        for cam_name in capfmt.find_cameras(scene_folder):
+            sync_file = os.path.join(scene_folder, f'timestamp_camsync_{cam_name}.tsv')
+            timestamp_file = ximea_timestamp_file(scene_folder, cam_name)
+            if(os.path.exists(sync_file) and os.path.exists(timestamp_file)):
+                streams[cam_name] = ximea_unix_timestamps(timestamp_file, sync_file)
+    eye_folder = os.path.join(session_folder, 'eye_camera')
+    #pupil time starts out as unix time, correct its drift if it was sampled during the collection
+    pupil_to_unix = None
+    pupil_sync_file = os.path.join(scene_folder, 'timestamp_camsync_pupil.tsv')
+    if(os.path.exists(pupil_sync_file)):
+        t_wall, t_pupil = load_camsync_table(pupil_sync_file)
+        if(len(t_wall)):
+            pupil_to_unix = fit_clock_model(t_pupil, t_wall)
+    for timestamp_file in sorted(glob.glob(os.path.join(eye_folder, '**', '*_timestamps.npy'), recursive=True)):
+        stream_name = os.path.basename(timestamp_file)[:-len('_timestamps.npy')]
+        timestamps = np.load(timestamp_file)
+        if(pupil_to_unix is not None):
+            timestamps = pupil_to_unix(timestamps)
+        streams[stream_name] = (np.arange(len(timestamps)), timestamps)
+    imu_folder = os.path.join(session_folder, 'imu')
+    for imu_file in sorted(glob.glob(os.path.join(imu_folder, 'imu_data_*.tsv'))):
+        stream_name = 'imu_' + os.path.basename(imu_file)[len('imu_data_'):-len('.tsv')]
+        try:
+            streams[stream_name] = realsense_unix_timestamps(imu_file)
+        except ValueError as e:
+            print(e)
+    return(streams)
+
+def build_sync_table(streams, reference=None, rate=None, tolerance=None):
+    '''
+    Line up several streams against one set of reference ticks.
+    For every tick and stream, find the nearest frame and how far its timestamp is from the tick.
+    Each stream is matched with a single searchsorted, so this stays fast for long sessions.
+    Params:
+        streams (dict): stream name -> (frame numbers, timestamps), all on the same clock
+        reference (str): name of the stream whose timestamps are the ticks
+        rate (float): if reference is None, ticks at this rate (Hz) over the time all streams overlap
+        tolerance (float): frames further than this (seconds) from a tick are marked -1 (no match)
+    Returns:
+        sync_table (dict): column name -> 1d np array. 'tick' holds the tick times,
+                           '{stream}_frame' the matched frame numbers and '{stream}_residual'
+                           the frame timestamp minus the tick time.
+    '''
+    if(reference is not None):
+        ticks = np.sort(np.asarray(streams[reference][1], dtype=np.double))
+    elif(rate is not None):
+        t_start = max(np.min(ts) for _, ts in streams.values() if len(ts))
+        t_end = min(np.max(ts) for _, ts in streams.values() if len(ts))
+        ticks = np.arange(t_start, t_end, 1/rate)
+    else:
+        raise ValueError('Specify a reference stream or a tick rate')
+    sync_table = {'tick': ticks}
+    for stream_name, (frames, timestamps) in streams.items():
+        if(len(timestamps) == 0):
+            sync_table[f'{stream_name}_frame'] = np.full(len(ticks), -1, dtype=np.int64)
+            sync_table[f'{stream_name}_residual'] = np.full(len(ticks), np.nan)
+            continue
+        matched_frames, matched_times = TimestampIndex(frames, timestamps).nearest_frame(ticks)
+        residual = matched_times - ticks
+        matched_frames = matched_frames.astype(np.int64)
+        if(tolerance is not None):
+            matched_frames[np.abs(residual) > tolerance] = -1
+        sync_table[f'{stream_name}_frame'] = matched_frames
+        sync_table[f'{stream_name}_residual'] = residual
+    return(sync_table)
+
+def run_sync_analysis(session_folder, sync_file, reference='cy', rate=None, tolerance=None):
+    '''
+    Build the synchronization table for a collection and save it as an .npz of columns.
+    Params:
+        session_folder (str): folder of one collection (holding scene_camera, eye_camera, imu)
+        sync_file (str): .npz file to write
+        reference (str): stream to use as the ticks (ignored if rate is given)
+        rate (float): tick rate in Hz instead of a reference stream
+        tolerance (float): max distance in seconds for a frame to count as matched
+    Returns:
+        sync_table (dict): column name -> 1d np array
+    '''
+    streams = load_session_streams(session_folder)
+    print(f'Syncing streams: {list(streams)}')
+    sync_table = build_sync_table(streams, reference=None if rate else reference, rate=rate, tolerance=tolerance)
+    np.savez(sync_file, **sync_table)
+    return(sync_table)
@@ -10,7 +10,7 @@ import pupil_cam_aquire_save as pup
 def run_experiment(subject_name=None, 
                    task_name=None, 
                    exp_type=None, 
-                   save_dirs='./capture',
+                   save_dirs=['./capture'],
                    collection_minutes=1,
                    save_batchsize=100,
                    pupil_port=None,
@@ -22,7 +22,8 @@ def run_experiment(subject_name=None,
         subject (string): Subject ID to be included in file structure
         task_name (string): Name of task to be included in file structure
         exp_type (string): Type of experiment, either 'pre', 'post', or 'exp'
-        save_dirs (list of strings): Name of base directories to save experiment files
+        save_dirs (list of strings): Name of base directories to save experiment files,
+                                     scene camera frames are striped across all of them
         save_batchsize (int): how many camera frames per file?
         
     '''
@@ -37,10 +38,11 @@ def run_experiment(subject_name=None,
     #create directory structure for saving
     scene_cam_folders = [os.path.join(save_dir, subject_name, task_name, exp_type,
                                       'scene_camera') for save_dir in save_dirs]
-    if not os.path.exists(scene_cam_folders[0]):
-        oldmask = os.umask(000)
-        os.makedirs(scene_cam_folders[0], 777)
-        os.umask(oldmask)
+    for scene_cam_folder in scene_cam_folders:
+        if not os.path.exists(scene_cam_folder):
+            oldmask = os.umask(000)
+            os.makedirs(scene_cam_folder, 777)
+            os.umask(oldmask)
             
     eye_cam_folder = os.path.join(save_dirs[0], subject_name, task_name, exp_type,
                                   'eye_camera')
@@ -79,7 +81,8 @@ def run_experiment(subject_name=None,
     scene_camera_thread = xim.ximea_acquire(scene_cam_folders,
                                       collection_minutes, 
                                       save_batchsize,
-                                           num_cameras=n_cameras)
+                                           num_cameras=n_cameras,
+                                           pupil_port=pupil_port)
     
     print(f'Main Thread: All Done! Collected for {collection_minutes} minutes')
 
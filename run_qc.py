@@ -0,0 +1,160 @@
+'''
+Nightly QC over a whole capture tree: capture/<subject>/<task>/<exp>.
+Every session with a scene camera gets timing, dframe and drop plots per camera and a
+summary.tsv, rendered headless on a process pool. Sessions whose inputs have not changed
+since the last run (recorded in qc_manifest.yaml) are skipped. The capture tree is only read,
+everything QC writes goes under the qc directory.
+
+    python run_qc.py ./capture ./qc
+'''
+
+import matplotlib
+#render to files only, so plotting works in worker processes without a display
+matplotlib.use('Agg')
+
+import os
+import glob
+import hashlib
+import argparse
+import time
+from multiprocessing import Pool
+import numpy as np
+import yaml
+import run_analysis as ana
+
+SUMMARY_HEADER = 'cam\tframes\tmissed\tmissed_pct\tduration_s\tmedian_dt\tmean_dt\tp99_dt\tmax_dt\n'
+
+def find_sessions(capture_dir):
+    '''
+    Sessions in a capture tree that have scene camera recordings.
+    Params:
+        capture_dir (str): base capture directory
+    Returns:
+        sessions (list of str): session paths relative to capture_dir (subject/task/exp)
+    '''
+    scene_folders = glob.glob(os.path.join(capture_dir, '*', '*', '*', 'scene_camera'))
+    return(sorted(os.path.relpath(os.path.dirname(folder), capture_dir) for folder in scene_folders))
+
+def session_fingerprint(scene_folder):
+    '''
+    Hash of the name, size and mtime of every file QC reads for a session.
+    '''
+    inputs = []
+    for pattern in ('timestamps_*.idx', 'timestamps_*.tsv', 'metadata_*.yaml', 'timing_summary.yaml'):
+        for file_name in sorted(glob.glob(os.path.join(scene_folder, pattern))):
+            st = os.stat(file_name)
+            inputs.append(f'{os.path.basename(file_name)}:{st.st_size}:{st.st_mtime_ns}')
+    return(hashlib.sha1('\n'.join(inputs).encode()).hexdigest())
+
+def camera_timestamp_files(scene_folder):
+    '''
+    Timestamp file of each camera in a session: the binary index, or the tsv
+    of sessions recorded before the index existed.
+    Returns:
+        timestamp_files (dict): camera name -> timestamp file
+    '''
+    timestamp_files = {}
+    for extension in ('.tsv', '.idx'):
+        for file_name in glob.glob(os.path.join(scene_folder, f'timestamps_*{extension}')):
+            timestamp_files[os.path.basename(file_name)[len('timestamps_'):-len(extension)]] = file_name
+    return(dict(sorted(timestamp_files.items())))
+
+def camera_summary(timestamp_file, cam_name):
+    '''
+    One summary.tsv row for a camera.
+    '''
+    ts_table = ana.load_timestamp_table(timestamp_file, cache=False)
+    frames = len(ts_table)
+    missed = int(np.sum(np.maximum(np.diff(ts_table[:,1]) - 1, 0)))
+    dt = np.diff(ts_table[:,2])
+    if(len(dt) == 0):
+        dt = np.array([np.nan])
+    duration = ts_table[-1,2] - ts_table[0,2] if frames else 0.
+    return(f'{cam_name}\t{frames}\t{missed}\t{100*missed/max(frames + missed, 1):.3f}\t{duration:.3f}\t'
+           f'{np.median(dt):.6f}\t{np.mean(dt):.6f}\t{np.percentile(dt, 99):.6f}\t{np.max(dt):.6f}\n')
+
+def qc_session(task):
+    '''
+    Render the QC plots and summary table of one session.
+    Params:
+        task (tuple): (capture_dir, session, qc_dir, fingerprint)
+    Returns:
+        session (str): session processed
+        fingerprint (str): inputs fingerprint, None if QC failed or the session has no timestamps
+        message (str): summary or error
+    '''
+    capture_dir, session, qc_dir, fingerprint = task
+    scene_folder = os.path.join(capture_dir, session, 'scene_camera')
+    write_folder = os.path.join(qc_dir, session)
+    try:
+        if not os.path.exists(write_folder):
+            os.makedirs(write_folder)
+        timestamp_files = camera_timestamp_files(scene_folder)
+        if not timestamp_files:
+            #leave it out of the manifest, so it is reported again rather than passing as done
+            return(session, None, 'unsupported: no timestamps_*.idx or timestamps_*.tsv files')
+        rows = []
+        for cam_name, timestamp_file in timestamp_files.items():
+            ts_table = ana.load_timestamp_table(timestamp_file, cache=False)
+            if(ts_table.ndim < 2 or len(ts_table) < 2):
+                continue
+            ana.plot_camera_timing(timestamp_file, os.path.join(write_folder, f'{cam_name}_timing.png'), cam_name, show=False, cache=False)
+            ana.plot_camera_dframe(timestamp_file, os.path.join(write_folder, f'{cam_name}_dframe.png'), cam_name, show=False, cache=False)
+            ana.plot_camera_drops(timestamp_file, os.path.join(write_folder, f'{cam_name}_drops.png'), cam_name, show=False, cache=False)
+            rows.append(camera_summary(timestamp_file, cam_name))
+        with open(os.path.join(write_folder, 'summary.tsv'), 'w') as f:
+            f.write(SUMMARY_HEADER)
+            f.writelines(rows)
+        return(session, fingerprint, f'{len(rows)} cameras')
+    except Exception as e:
+        return(session, None, f'QC failed: {e}')
+
+def run_qc(capture_dir='./capture', qc_dir='./qc', n_workers=None, force=False):
+    '''
+    QC every session in a capture tree that changed since the last run, on a process pool.
+    Params:
+        capture_dir (str): base capture directory (capture/<subject>/<task>/<exp>)
+        qc_dir (str): directory to write plots and summaries to, mirroring the capture tree
+        n_workers (int): worker processes, one per core if None
+        force (bool): redo sessions even if their inputs have not changed
+    Returns:
+        results (dict): session -> summary or error of the sessions processed
+    '''
+    if not os.path.exists(qc_dir):
+        os.makedirs(qc_dir)
+    manifest_file = os.path.join(qc_dir, 'qc_manifest.yaml')
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = yaml.safe_load(f) or {}
+
+    tasks = []
+    sessions = find_sessions(capture_dir)
+    for session in sessions:
+        fingerprint = session_fingerprint(os.path.join(capture_dir, session, 'scene_camera'))
+        if(force or manifest.get(session) != fingerprint):
+            tasks.append((capture_dir, session, qc_dir, fingerprint))
+    print(f'QC: {len(sessions)} sessions, {len(sessions) - len(tasks)} unchanged, {len(tasks)} to process...')
+
+    t_start = time.time()
+    results = {}
+    with Pool(n_workers) as pool:
+        for session, fingerprint, message in pool.imap_unordered(qc_session, tasks):
+            print(f'QC {session}: {message}')
+            results[session] = message
+            if(fingerprint is not None):
+                manifest[session] = fingerprint
+                #save after every session, so an interrupted run keeps its progress
+                with open(manifest_file, 'w') as f:
+                    yaml.dump(manifest, f, default_flow_style=False)
+    print(f'QC finished in {time.time()-t_start:.1f} seconds.')
+    return(results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless QC plots and summaries for every session in a capture tree.')
+    parser.add_argument('capture_dir', nargs='?', default='./capture')
+    parser.add_argument('qc_dir', nargs='?', default='./qc')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='redo sessions that have not changed')
+    args = parser.parse_args()
+    run_qc(args.capture_dir, args.qc_dir, args.workers, args.force)
@@ -23,5 +23,5 @@ cams = ['cy','os','od']
 for i in range(ncams):
 	with open(percent_dropped_file, 'a+') as f:
 		cam_name = cams[i]
-		percentage_dropped_frames = ana.count_missed_frames(f'{save_folder}/timestamps_{cam_name}.tsv', cam_name)
+		percentage_dropped_frames = ana.count_missed_frames(f'{save_folder}/timestamps_{cam_name}.idx', cam_name)
 		f.write(f"{time.time()}\t{cam_name}\t{percentage_dropped_frames}\n")
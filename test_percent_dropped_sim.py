@@ -0,0 +1,33 @@
+import ximea_cam_aquire_save as xim
+import ximea_sim
+import run_analysis as ana
+
+import time
+
+collection_mins = 0.1
+save_batchsize = 200
+
+save_folder = './test/testing_framedrops_sim'
+save_folder_list= [save_folder, save_folder]
+
+ncams = 3
+
+#simulated cameras, so this runs on any linux box. set drops/jitter to test the analysis side.
+backend = ximea_sim.backend(drop_probability=0.0, jitter_us=0.0)
+
+print(f'Collecting for {collection_mins*60.} seconds...')
+t_start = time.time()
+xim.ximea_acquire(save_folder_list, max_collection_mins=collection_mins, ims_per_file=save_batchsize, num_cameras=ncams,
+                  memsize=2, backend=backend)
+print(f'Acquisition took {time.time()-t_start:.2f} seconds')
+
+print('Done Recording. Counting Missed Frames...')
+
+percent_dropped_file = f'{save_folder}/aggregate_framedrop.tsv'
+
+cams = ['cy','os','od']
+for i in range(ncams):
+	with open(percent_dropped_file, 'a+') as f:
+		cam_name = cams[i]
+		percentage_dropped_frames = ana.count_missed_frames(f'{save_folder}/timestamps_{cam_name}.idx', cam_name)
+		f.write(f"{time.time()}\t{cam_name}\t{percentage_dropped_frames}\n")
@@ -1,11 +1,16 @@
 import copy
-#import multiprocessing as mp
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
 import threading
 import queue as queue
 import time
 import os as os
 import numpy as np
-from ximea import xiapi
+try:
+    from ximea import xiapi
+except ImportError:
+    #without the XIMEA API only a simulated backend (ximea_sim) can be used
+    xiapi = None
 from collections import namedtuple
 import yaml
 import mmap
@@ -16,10 +21,606 @@ import signal
 import gc
 import ctypes
 import stat
+import itertools
+import math
+import socket
+import capture_format as capfmt
 
 #import pupil.pupil_src.shared_modules.time_sync as pup_time
 
-frame_data = namedtuple("frame_data", "raw_data nframe tsSec tsUSec")
+frame_data = namedtuple("frame_data", "slot nframe tsSec tsUSec t_acquired")
+#posted on a save queue by acquisition when a camera's stream has ended
+END_OF_STREAM = None
+
+class FramePool:
+    '''
+    Fixed pool of preallocated frame slots shared by one camera's acquisition and save workers.
+    Frames are copied once from the xiapi buffer into a free slot, only the slot number travels
+    through the save queue, and the save worker hands the slot back once the frame is on disk.
+    When the disk falls behind, acquisition waits on a free slot instead of growing memory.
+
+    With shared=True the slots live in multiprocessing.shared_memory and the free list is a
+    multiprocessing.Queue, so the pool can be handed to a save worker process, which attaches
+    to the same memory once acquisition has allocated it. Frame bytes are never pickled.
+
+    Slots are only backed by RAM once a frame is written into them. Without shared memory, free
+    slots are handed out last in first out, so the pool stays on a small set of warm slots unless
+    the disk falls behind. The free list of a shared pool is first in first out, so every slot gets
+    touched there, and sizing the pool by buffer_seconds keeps that bounded.
+    Params:
+        mem_bytes (int): memory budget in bytes for this camera's slots, sized by buffer_seconds if None
+        shared (bool): back the slots with shared memory for a save worker process?
+        buffer_seconds (float): seconds of frames at the camera's framerate to hold when mem_bytes is None
+    '''
+    def __init__(self, mem_bytes=None, shared=False, buffer_seconds=2.0):
+        self.mem_bytes = None if mem_bytes is None else int(mem_bytes)
+        self.buffer_seconds = buffer_seconds
+        self.shared = shared
+        self.frame_size = None
+        self.n_slots = 0
+        self.buffer = None
+        if(shared):
+            self.name = f'frame_pool_{os.getpid()}_{id(self)}'
+            self.free_slots = mp.Queue()
+            self.allocated = mp.Event()
+            self.layout = mp.Array('q', 3, lock=False)
+        else:
+            self.free_slots = queue.LifoQueue()
+            self.allocated = threading.Event()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('buffer', 'buffer_view', 'base_address'):
+            state.pop(key, None)
+        return(state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buffer = None
+
+    def allocate(self, frame_size, framerate=None):
+        '''
+        Allocate the slots once the frame size is known. Slots are page aligned.
+        Params:
+            frame_size (int): size in bytes of a single raw frame
+            framerate (float): camera framerate, needed to size the pool when it has no memory budget
+        '''
+        frame_size = int(frame_size)
+        slot_stride = -(-frame_size // mmap.PAGESIZE) * mmap.PAGESIZE
+        if(self.mem_bytes is None):
+            if(framerate is None):
+                raise ValueError('A frame pool without a memory budget needs the framerate to size it')
+            n_slots = max(int(math.ceil(self.buffer_seconds * framerate)), 2)
+        else:
+            n_slots = self.mem_bytes // slot_stride
+        if(n_slots < 2):
+            raise ValueError(f'Frame pool of {self.mem_bytes} bytes cannot hold two {frame_size} byte frames')
+        if(self.shared):
+            self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=n_slots*slot_stride)
+            self._map(self.shm.buf, frame_size, slot_stride, n_slots)
+            self.layout[:] = [frame_size, slot_stride, n_slots]
+        else:
+            self._map(mmap.mmap(-1, n_slots*slot_stride), frame_size, slot_stride, n_slots)
+        for slot in range(self.n_slots):
+            self.free_slots.put(slot)
+        self.allocated.set()
+
+    def _map(self, buffer, frame_size, slot_stride, n_slots):
+        self.frame_size = frame_size
+        self.slot_stride = slot_stride
+        self.n_slots = n_slots
+        self.buffer = buffer
+        self.buffer_view = memoryview(buffer)
+        self.base_address = ctypes.addressof(ctypes.c_char.from_buffer(self.buffer))
+
+    def wait_allocated(self):
+        '''
+        Block until acquisition has allocated the slots, and return the frame size.
+        In a save worker process this also attaches to the shared slots.
+        '''
+        self.allocated.wait()
+        if(self.buffer is None):
+            self.shm = shared_memory.SharedMemory(name=self.name)
+            #the creating process owns the memory, keep this process's tracker from unlinking it
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+            self._map(self.shm.buf, *self.layout)
+        return(self.frame_size)
+
+    def close(self):
+        '''
+        Free shared slots once every worker is done with them.
+        '''
+        if(self.shared and self.buffer is not None):
+            self.buffer_view.release()
+            self.buffer = None
+            self.shm.close()
+            self.shm.unlink()
+
+    def acquire(self):
+        '''
+        Block until a slot is free and return its number.
+        '''
+        return(self.free_slots.get())
+
+    def release(self, slot):
+        '''
+        Hand a slot back to the pool once its frame has been written.
+        '''
+        self.free_slots.put(slot)
+
+    def fill(self, slot, image):
+        '''
+        Copy the frame held in the xiapi image buffer straight into a slot (no intermediate bytes object).
+        Params:
+            slot (int): slot to fill
+            image (xiapi.Image): image returned by camera.get_image
+        '''
+        ctypes.memmove(self.base_address + slot*self.slot_stride, image.bp, self.frame_size)
+
+    def view(self, slot):
+        '''
+        Zero-copy view of the frame held in a slot.
+        '''
+        start = slot*self.slot_stride
+        return(self.buffer_view[start:start+self.frame_size])
+
+    def in_use(self):
+        '''
+        Number of slots currently holding unwritten frames.
+        '''
+        return(self.n_slots - self.free_slots.qsize())
+
+class PipelineMetrics:
+    '''
+    Live counters for one camera's acquisition and save pipeline, updated from the hot loops
+    and read by a MetricsSampler. Values live in a shared ctypes array, so the same object
+    works for save threads and save processes. Each field has a single writer, so no locking.
+    '''
+    FIELDS = ('acquired', 'written', 'bytes_written', 'nframe_gaps', 'last_nframe', 'oldest_pending')
+    ACQUIRED, WRITTEN, BYTES_WRITTEN, NFRAME_GAPS, LAST_NFRAME, OLDEST_PENDING = range(len(FIELDS))
+
+    def __init__(self):
+        self.values = mp.Array('d', len(self.FIELDS), lock=False)
+
+    def frame_acquired(self, nframe):
+        '''
+        Count a frame taken from the camera, and any camera frames skipped before it.
+        '''
+        values = self.values
+        if(values[self.ACQUIRED] > 0):
+            values[self.NFRAME_GAPS] += max(nframe - values[self.LAST_NFRAME] - 1, 0)
+        values[self.LAST_NFRAME] = nframe
+        values[self.ACQUIRED] += 1
+
+    def frame_pending(self, t_acquired):
+        '''
+        Mark the frame the save worker is about to write (the oldest unwritten frame).
+        '''
+        self.values[self.OLDEST_PENDING] = t_acquired
+
+    def frame_written(self, nbytes):
+        '''
+        Count a frame handed to the batch writer.
+        '''
+        self.values[self.WRITTEN] += 1
+        self.values[self.BYTES_WRITTEN] += nbytes
+
+    def snapshot(self):
+        return(dict(zip(self.FIELDS, self.values[:])))
+
+class StreamingStats:
+    '''
+    Running count, mean, variance (Welford), min and max of a non-negative quantity, with a
+    log binned sketch (bins 1% wide from 1 microsecond) for quantiles. Cheap enough to update
+    per frame, and mergeable, so statistics kept by separate workers can be combined.
+    '''
+    SKETCH_MIN = 1e-6
+    SKETCH_LOG_GROWTH = math.log(1.01)
+    SKETCH_BINS = 2000
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = np.zeros(self.SKETCH_BINS, dtype=np.int64)
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+        b = int(math.log(max(x, self.SKETCH_MIN) / self.SKETCH_MIN) / self.SKETCH_LOG_GROWTH)
+        self.sketch[min(b, self.SKETCH_BINS-1)] += 1
+
+    def merge(self, other):
+        n = self.n + other.n
+        if(n == 0):
+            return(self)
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta**2 * self.n * other.n / n
+        self.mean += delta * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch += other.sketch
+        return(self)
+
+    def quantile(self, q):
+        if(self.n == 0):
+            return(math.nan)
+        b = int(np.searchsorted(np.cumsum(self.sketch), q*self.n))
+        #middle of the bin, kept within the values seen
+        value = self.SKETCH_MIN * math.exp((b + 0.5) * self.SKETCH_LOG_GROWTH)
+        return(min(max(value, self.min), self.max))
+
+    def summary(self):
+        if(self.n == 0):
+            return({'count': 0})
+        return({'count': self.n,
+                'mean': float(self.mean),
+                'std': float(math.sqrt(self.m2 / self.n)),
+                'min': float(self.min),
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'max': float(self.max)})
+
+    def to_dict(self):
+        nonzero = np.flatnonzero(self.sketch)
+        return({'n': self.n, 'mean': float(self.mean), 'm2': float(self.m2),
+                'min': float(self.min), 'max': float(self.max),
+                'sketch': {int(b): int(self.sketch[b]) for b in nonzero}})
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls()
+        stats.n, stats.mean, stats.m2, stats.min, stats.max = d['n'], d['mean'], d['m2'], d['min'], d['max']
+        for b, count in d['sketch'].items():
+            stats.sketch[int(b)] = count
+        return(stats)
+
+class TimingStats:
+    '''
+    Timing statistics of one camera, accumulated by its save worker as frames are written,
+    so the drop and timing report exists as soon as recording stops:
+        dt: camera time between consecutive saved frames
+        gaps: camera frames missing before each saved frame (nframe jumps)
+        latency: host time from a frame leaving the camera to it being written
+        disparity: host arrival time difference to the same collection index of each other camera
+    Arrival times are shared between save workers through a small ring (see new_arrival_ring);
+    whichever camera writes a collection index later records the disparity.
+    Params:
+        cam_names (list of str): every camera's name
+        cam_name (str): this camera
+        arrival_ring (mp.Array): shared arrival ring, None to skip disparity
+    '''
+    RING_FRAMES = 1024
+
+    def __init__(self, cam_names, cam_name, arrival_ring=None):
+        self.cam_name = cam_name
+        self.cam_index = cam_names.index(cam_name)
+        self.others = [(k, other) for k, other in enumerate(cam_names) if other != cam_name]
+        self.arrival_ring = arrival_ring
+        self.dt = StreamingStats()
+        self.latency = StreamingStats()
+        self.disparity = {other: StreamingStats() for _, other in self.others}
+        self.gaps = {}
+        self.frames = 0
+        self.dropped = 0
+        self.last_nframe = None
+        self.last_t_cam = None
+
+    @classmethod
+    def new_arrival_ring(cls, n_cameras):
+        '''
+        Shared (collection index + 1, arrival time) pairs of the last RING_FRAMES frames of every camera.
+        '''
+        return(mp.Array('d', n_cameras * cls.RING_FRAMES * 2, lock=False))
+
+    def frame_saved(self, index, nframe, t_cam, t_acquired, t_written):
+        self.frames += 1
+        if(self.last_nframe is not None):
+            self.dt.add(abs(t_cam - self.last_t_cam))
+            gap = nframe - self.last_nframe - 1
+            if(gap > 0):
+                self.gaps[gap] = self.gaps.get(gap, 0) + 1
+                self.dropped += gap
+        self.last_nframe = nframe
+        self.last_t_cam = t_cam
+        self.latency.add(max(t_written - t_acquired, 0))
+        if(self.arrival_ring is not None):
+            ring = self.arrival_ring
+            pos = index % self.RING_FRAMES
+            for k, other in self.others:
+                other_pos = 2 * (k*self.RING_FRAMES + pos)
+                if(ring[other_pos] == index + 1):
+                    self.disparity[other].add(abs(t_acquired - ring[other_pos + 1]))
+            own_pos = 2 * (self.cam_index*self.RING_FRAMES + pos)
+            #time before index, so another camera seeing the index also sees its time
+            ring[own_pos + 1] = t_acquired
+            ring[own_pos] = index + 1
+
+    def to_dict(self):
+        return({'frames': self.frames,
+                'dropped': self.dropped,
+                'gaps': dict(self.gaps),
+                'dt': self.dt.to_dict(),
+                'latency': self.latency.to_dict(),
+                'disparity': {other: stats.to_dict() for other, stats in self.disparity.items()}})
+
+def write_timing_summary(save_folder, cam_names):
+    '''
+    Merge the timing statistics each save worker kept into one summary of the collection,
+    written to timing_summary.yaml.
+    Params:
+        save_folder (str): folder the save workers wrote their timing statistics in
+        cam_names (list of str): camera names
+    Returns:
+        summary (dict): per camera frames, drops and dt/latency statistics, and disparity per camera pair
+    '''
+    timing = {}
+    for cam_name in cam_names:
+        file_name = capfmt.timing_file_name(save_folder, cam_name)
+        if os.path.exists(file_name):
+            with open(file_name, 'r') as f:
+                timing[cam_name] = yaml.safe_load(f)
+    summary = {'cameras': {}, 'disparity': {}}
+    disparity = {}
+    for cam_name, t in timing.items():
+        expected = t['frames'] + t['dropped']
+        summary['cameras'][cam_name] = {'frames': t['frames'],
+                                        'dropped': t['dropped'],
+                                        'discarded': t.get('discarded', 0),
+                                        'drop_rate': t['dropped'] / expected if expected else 0.,
+                                        'gaps': t['gaps'],
+                                        'dt': StreamingStats.from_dict(t['dt']).summary(),
+                                        'latency': StreamingStats.from_dict(t['latency']).summary()}
+        for other, stats in t['disparity'].items():
+            pair = '-'.join(sorted((cam_name, other)))
+            disparity.setdefault(pair, StreamingStats()).merge(StreamingStats.from_dict(stats))
+    summary['disparity'] = {pair: stats.summary() for pair, stats in disparity.items()}
+    with open(capfmt.timing_file_name(save_folder), 'w') as f:
+        yaml.dump(summary, f, default_flow_style=False)
+    return(summary)
+
+def print_timing_summary(summary, component_name='SCENE_CAM'):
+    for cam_name, cam in summary.get('cameras', {}).items():
+        dt = cam['dt']
+        print(f"{component_name} {cam_name}: {cam['frames']} frames saved, {cam['dropped']} dropped "
+              f"({100*cam['drop_rate']:.3f}%), dt mean {dt.get('mean', math.nan)*1000:.3f} ms "
+              f"p99 {dt.get('p99', math.nan)*1000:.3f} ms, write latency p99 {cam['latency'].get('p99', math.nan)*1000:.1f} ms")
+        if(cam.get('discarded', 0)):
+            print(f"{component_name} {cam_name}: {cam['discarded']} acquired frames discarded after a save error")
+    for pair, disparity in summary.get('disparity', {}).items():
+        print(f"{component_name} {pair} disparity: mean {disparity.get('mean', math.nan)*1000:.3f} ms "
+              f"p99 {disparity.get('p99', math.nan)*1000:.3f} ms")
+
+class MetricsSampler:
+    '''
+    Periodically sample every camera's PipelineMetrics on a background thread and append
+    them to a telemetry tsv file (and optionally send them as UDP datagrams to a local port),
+    so the operator can see a disk falling behind while recording.
+    Params:
+        cam_names (list of str): camera names
+        metrics (list of PipelineMetrics): metrics for each camera
+        frame_pools (list of FramePool): frame pools for each camera
+        save_queues (list of queues): save queues for each camera
+        telemetry_file (str): tsv file to append samples to
+        interval (float): seconds between samples
+        udp_port (int): also send each sample line to this port on localhost
+    '''
+    HEADER = 'time\tcam\tacquired\twritten\tqueue_depth\tslots_in_use\tslots\tMBps_written\tnframe_gaps\toldest_unwritten_age\n'
+
+    def __init__(self, cam_names, metrics, frame_pools, save_queues, telemetry_file, interval=1.0, udp_port=None):
+        self.cam_names = cam_names
+        self.metrics = metrics
+        self.frame_pools = frame_pools
+        self.save_queues = save_queues
+        self.telemetry_file = telemetry_file
+        self.interval = interval
+        self.udp_port = udp_port
+        self.stop_sampling = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stop sampling after one last sample.
+        '''
+        self.stop_sampling.set()
+        self.thread.join()
+
+    def _run(self):
+        sock = None
+        if(self.udp_port is not None):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        t_last = time.monotonic()
+        bytes_last = [0 for _ in self.metrics]
+        with open(self.telemetry_file, 'w') as f:
+            f.write(self.HEADER)
+            while True:
+                stopping = self.stop_sampling.wait(self.interval)
+                now = time.monotonic()
+                dt = max(now - t_last, 1e-9)
+                t_last = now
+                for i, cam_name in enumerate(self.cam_names):
+                    sample = self.metrics[i].snapshot()
+                    mbps = (sample['bytes_written'] - bytes_last[i]) / dt / 2**20
+                    bytes_last[i] = sample['bytes_written']
+                    age = now - sample['oldest_pending'] if sample['acquired'] > sample['written'] else 0
+                    line = (f"{time.time():.3f}\t{cam_name}\t{sample['acquired']:.0f}\t{sample['written']:.0f}\t"
+                            f"{self.save_queues[i].qsize()}\t{self.frame_pools[i].in_use()}\t{self.frame_pools[i].n_slots}\t"
+                            f"{mbps:.1f}\t{sample['nframe_gaps']:.0f}\t{age:.3f}\n")
+                    f.write(line)
+                    if(sock is not None):
+                        sock.sendto(line.encode(), ('127.0.0.1', self.udp_port))
+                f.flush()
+                if(stopping):
+                    break
+        if(sock is not None):
+            sock.close()
+
+class ClockSyncSampler:
+    '''
+    Collect clock sync pairs every few seconds during acquisition so drift can be fit over the whole session.
+    Camera clocks are only read from their acquisition thread: this thread raises a per-camera flag and
+    the acquisition loop takes the sample between frames (one timestamp read), so get_image never waits
+    on it. Pupil time, which needs a round trip to pupil capture, is sampled here off the frame path.
+    Params:
+        cam_names (list of str): camera names
+        interval (float): seconds between sync samples
+        pupil_time_fn (function): returns the current pupil time, None to skip pupil sampling
+        pupil_sync_file (str): tsv file to write pupil/wall pairs to
+    '''
+    def __init__(self, cam_names, interval=5.0, pupil_time_fn=None, pupil_sync_file=None):
+        self.interval = interval
+        self.sync_requested = {cam_name: threading.Event() for cam_name in cam_names}
+        self.pupil_time_fn = pupil_time_fn
+        self.pupil_sync_file = pupil_sync_file
+        self.stop_sampling = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_sampling.set()
+        self.thread.join()
+
+    def _sample_pupil(self, f, name):
+        t_wall_1 = time.time()
+        t_pupil = self.pupil_time_fn()
+        t_wall_2 = time.time()
+        f.write(f'{name}\t{np.mean((t_wall_1, t_wall_2))}\t{t_pupil}\n')
+        f.flush()
+
+    def _run(self):
+        f = None
+        if(self.pupil_time_fn is not None):
+            f = open(self.pupil_sync_file, 'w')
+            f.write(f"tcam_name\t_wall\t_cam\n")
+        try:
+            while not self.stop_sampling.wait(self.interval):
+                for sync_requested in self.sync_requested.values():
+                    sync_requested.set()
+                if(f is not None):
+                    try:
+                        self._sample_pupil(f, 'pupil')
+                    except Exception as e:
+                        print(f'Pupil time sync sample failed: {e}')
+        finally:
+            if(f is not None):
+                f.close()
+
+def get_frame_format(cam):
+    '''
+    Format frames from the camera are saved in, with the camera's current settings:
+    its image data format, or a capture_format.PACKED_FORMATS format when output bit packing is on.
+    Raises ValueError for formats frames can not be saved in (eg XI_RGB24), before acquisition starts.
+    Params:
+        cam (XimeaCamera instance): camera handle
+    Returns:
+        img_format (str): format name recorded in the session metadata
+        bit_depth (int): significant bits per pixel
+    '''
+    bit_depth = int(str(cam.get_output_bit_depth()).replace('XI_BPP_', ''))
+    if(cam.is_output_bit_packing()):
+        packing_type = cam.get_output_bit_packing_type()
+        if(packing_type != 'XI_DATA_PACK_PFNC_LSB_PACKING'):
+            raise ValueError(f'Only PFNC LSB bit packing can be saved, camera is set to {packing_type}')
+        return(capfmt.packed_format(bit_depth), bit_depth)
+    img_format = cam.get_imgdataformat()
+    if img_format not in capfmt.RAW_DTYPES:
+        raise ValueError(f'Frames in {img_format} format can not be saved, set imgdataformat to one of '
+                         f'{sorted(capfmt.RAW_DTYPES)} or record with PFNC LSB bit packing')
+    if(capfmt.RAW_DTYPES[img_format].itemsize == 1):
+        bit_depth = 8
+    return(img_format, bit_depth)
+
+def enable_bit_packing(cam, bit_depth):
+    '''
+    Record bit_depth bit pixels packed with PFNC LSB packing (1.25 bytes per pixel at 10 bits,
+    1.5 at 12) instead of 8 bit or 16 bit unpacked pixels. Frames come from the camera packed
+    (transport data format), are saved as they are and unpacked when read.
+    Params:
+        cam (XimeaCamera instance): camera handle
+        bit_depth (int): 10 or 12
+    '''
+    bpp = f'XI_BPP_{bit_depth}'
+    capfmt.packed_format(bit_depth)
+    cam.set_sensor_bit_depth(bpp)
+    cam.set_output_bit_depth(bpp)
+    cam.set_image_data_bit_depth(bpp)
+    cam.set_output_bit_packing_type('XI_DATA_PACK_PFNC_LSB_PACKING')
+    cam.enable_output_bit_packing()
+    cam.set_imgdataformat('XI_FRM_TRANSPORT_DATA')
+
+# camera settings that determine the layout of saved frames, snapshotted into the session metadata
+CAPTURE_SETTINGS = ('width', 'height', 'offsetX', 'offsetY',
+                    'downsampling', 'downsampling_type',
+                    'binning_selector', 'binning_horizontal', 'binning_vertical',
+                    'binning_horizontal_mode', 'binning_vertical_mode',
+                    'binning_horizontal_pattern', 'binning_vertical_pattern',
+                    'decimation_selector', 'decimation_horizontal', 'decimation_vertical',
+                    'decimation_horizontal_pattern', 'decimation_vertical_pattern',
+                    'framerate', 'exposure', 'gain', 'imgdataformat', 'sensor_bit_depth',
+                    'output_bit_depth', 'image_data_bit_depth', 'output_bit_packing_type',
+                    'color_filter_array')
+
+# xiapi color filter arrays as the Bayer pattern names used by readers (first row of the 2x2 cell)
+CFA_PATTERNS = {'XI_CFA_BAYER_RGGB': 'RG',
+                'XI_CFA_BAYER_BGGR': 'BG',
+                'XI_CFA_BAYER_GRBG': 'GR',
+                'XI_CFA_BAYER_GBRG': 'GB'}
+
+def get_capture_settings(cam):
+    '''
+    Snapshot of the camera's effective settings (CAPTURE_SETTINGS), as the camera reports them after they were applied.
+    Settings the camera does not support are left out.
+    Params:
+        cam (XimeaCamera instance): camera handle
+    Returns:
+        settings (dict): setting name -> value
+    '''
+    settings = {}
+    for key in CAPTURE_SETTINGS:
+        try:
+            settings[key] = cam.__getattribute__(f"get_{key}")()
+        except Exception:
+            continue
+    try:
+        settings['is_output_bit_packing'] = bool(cam.is_output_bit_packing())
+    except Exception:
+        pass
+    return(settings)
+
+def capture_bayer_pattern(settings):
+    '''
+    Bayer pattern of saved frames, from the camera's color filter array or, if it does not report one,
+    the sensor's GR pattern shifted by the region of interest offsets.
+    '''
+    if(settings.get('color_filter_array') in CFA_PATTERNS):
+        return(CFA_PATTERNS[settings['color_filter_array']])
+    return(capfmt.bayer_pattern(capfmt.DEFAULT_BAYER_PATTERN, settings.get('offsetX', 0), settings.get('offsetY', 0)))
+
+def get_frame_size(cam):
+    '''
+    Size in bytes of one raw frame with the camera's current settings.
+    Params:
+        cam (XimeaCamera instance): camera handle
+    Returns:
+        frame_size (int): bytes per frame
+    '''
+    img_format, _ = get_frame_format(cam)
+    return(capfmt.frame_nbytes((cam.get_height(), cam.get_width()), img_format))
 
 def get_sync_string(cam_name, cam_handle):
     '''
@@ -156,67 +757,388 @@ def apply_cam_settings(cam, config_file):
         else:
             print(f"Camera doesn't have a set_{prop}")
 
-def save_queue_worker(cam_name, save_queue_out, save_folder, ims_per_file=200):
+def open_batch_file(file_name, direct=True, sync=True):
+    '''
+    Open a batch file for writing, using O_DIRECT when the filesystem supports it.
+    Params:
+        file_name (str): path of the batch file
+        direct (bool): bypass the page cache with O_DIRECT?
+        sync (bool): open with O_SYNC so each write waits for the device?
+    Returns:
+        fd (int): file descriptor of the open batch file
+    '''
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if(sync):
+        flags |= os.O_SYNC
+    if(direct and hasattr(os, 'O_DIRECT')):
+        try:
+            return(os.open(file_name, flags | os.O_DIRECT, 0o777))
+        except OSError:
+            #tmpfs and some network filesystems refuse O_DIRECT
+            pass
+    return(os.open(file_name, flags, 0o777))
+
+class BatchWriter:
+    '''
+    Write frames into batch files through a page-aligned staging buffer.
+    Frames are packed back to back into the staging buffer, and it goes to disk in
+    write_size chunks, so every O_DIRECT write is aligned and covers several frames.
+    The unaligned tail of a file is padded out to a full page, written, and then
+    truncated away so the file holds exactly the frames given to it.
+    The staging buffer is allocated once and reused for every batch file.
+
+    Durability modes:
+        'write': files are opened O_SYNC, every write waits for the device
+        'group': fdatasync every sync_every_frames frames or sync_every_ms milliseconds,
+                 whichever comes first
+        'close': fdatasync once when each batch file is closed
+    With 'group' and 'close' a crash can lose the unsynced frames plus one staging buffer.
+    Params:
+        write_size (int): bytes per write syscall, rounded up to a whole number of pages
+        durability (str): one of DURABILITY_MODES
+        sync_every_frames (int): group commit frame interval
+        sync_every_ms (float): group commit time interval
+    '''
+    DURABILITY_MODES = ('write', 'group', 'close')
+
+    def __init__(self, write_size=8*2**20, durability='write', sync_every_frames=200, sync_every_ms=1000):
+        if(durability not in self.DURABILITY_MODES):
+            raise ValueError(f"durability must be one of {self.DURABILITY_MODES}, not {durability}")
+        self.write_size = max(1, -(-int(write_size) // mmap.PAGESIZE)) * mmap.PAGESIZE
+        self.durability = durability
+        self.sync_every_frames = sync_every_frames
+        self.sync_every_ms = sync_every_ms
+        self.staging = mmap.mmap(-1, self.write_size)
+        self.staging_view = memoryview(self.staging)
+        self.fd = None
+        self.fill = 0
+        self.nbytes = 0
+        self.unsynced_frames = 0
+        self.last_sync = time.monotonic()
+
+    def open(self, file_name):
+        '''
+        Open a batch file with the flags this writer's durability mode needs.
+        Params:
+            file_name (str): path of the batch file
+        Returns:
+            fd (int): file descriptor to pass to start
+        '''
+        return(open_batch_file(file_name, sync=(self.durability == 'write')))
+
+    def durability_metadata(self):
+        '''
+        Durability settings, for recording in the session metadata.
+        '''
+        metadata = {'mode': self.durability}
+        if(self.durability == 'group'):
+            metadata['sync_every_frames'] = self.sync_every_frames
+            metadata['sync_every_ms'] = self.sync_every_ms
+        return(metadata)
+
+    def start(self, fd):
+        '''
+        Start writing a new batch file.
+        Params:
+            fd (int): file descriptor from open_batch_file
+        '''
+        self.fd = fd
+        self.fill = 0
+        self.nbytes = 0
+
+    def write(self, data):
+        '''
+        Append a frame to the current batch file.
+        Params:
+            data (buffer): raw frame bytes (eg a FramePool slot view)
+        '''
+        data = memoryview(data).cast('B')
+        pos = 0
+        while pos < len(data):
+            n = min(len(data) - pos, self.write_size - self.fill)
+            self.staging_view[self.fill:self.fill+n] = data[pos:pos+n]
+            self.fill += n
+            pos += n
+            if(self.fill == self.write_size):
+                self._write_staging(self.write_size)
+        self.nbytes += len(data)
+        if(self.durability == 'group'):
+            self.unsynced_frames += 1
+            if(self.unsynced_frames >= self.sync_every_frames or
+               (time.monotonic() - self.last_sync)*1000 >= self.sync_every_ms):
+                self._sync()
+
+    def _sync(self):
+        os.fdatasync(self.fd)
+        self.unsynced_frames = 0
+        self.last_sync = time.monotonic()
+
+    def _write_staging(self, nbytes):
+        written = 0
+        while written < nbytes:
+            written += os.write(self.fd, self.staging_view[written:nbytes])
+        self.fill = 0
+
+    def close(self):
+        '''
+        Write out the tail of the current batch file, trim it to its real size and close it.
+        Returns:
+            nbytes (int): bytes of frame data in the closed file
+        '''
+        if(self.fill > 0):
+            self._write_staging(-(-self.fill // mmap.PAGESIZE) * mmap.PAGESIZE)
+        os.ftruncate(self.fd, self.nbytes)
+        if(self.durability in ('group', 'close')):
+            self._sync()
+        os.close(self.fd)
+        self.fd = None
+        return(self.nbytes)
+
+_libc = ctypes.CDLL(None, use_errno=True)
+FALLOC_FL_KEEP_SIZE = 0x01
+
+def preallocate_file(fd, nbytes):
+    '''
+    Reserve disk extents for a file without changing its size, so a file cut short by
+    a crash never looks longer than the frames written to it. Best effort: filesystems
+    without fallocate support are left alone.
+    Params:
+        fd (int): file descriptor
+        nbytes (int): bytes to reserve
+    '''
+    fallocate = getattr(_libc, 'fallocate', None)
+    if(fallocate is None):
+        return()
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, nbytes)
+    return()
+
+class BatchFilePreparer:
+    '''
+    Create and preallocate upcoming batch files on a background thread, so rolling over
+    to the next batch file in the save loop is just taking an already open descriptor.
+    Pre-created files that never receive frames are removed on close. If a file cannot be
+    created (eg disk full), the error is handed over in its place and raised by next().
+    Params:
+        open_file (function): opens a file name and returns a descriptor (eg BatchWriter.open)
+        file_names (iterable of str): batch file paths, in the order they will be written
+        prealloc_bytes (int): bytes to reserve for each file
+        n_ahead (int): how many files to keep ready
+    '''
+    def __init__(self, open_file, file_names, prealloc_bytes, n_ahead=1):
+        self.open_file = open_file
+        self.file_names = file_names
+        self.prealloc_bytes = prealloc_bytes
+        self.ready = queue.Queue(maxsize=n_ahead)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._prepare_files)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _hand_off(self, item):
+        '''
+        Put an item on the ready queue, giving up if the preparer is stopped.
+        Returns:
+            handed_off (bool): was the item queued?
+        '''
+        while not self.stop.is_set():
+            try:
+                self.ready.put(item, timeout=0.1)
+                return(True)
+            except queue.Full:
+                continue
+        return(False)
+
+    def _prepare_files(self):
+        for file_name in self.file_names:
+            fd = None
+            try:
+                fd = self.open_file(file_name)
+                preallocate_file(fd, self.prealloc_bytes)
+            except Exception as e:
+                if(fd is not None):
+                    self._discard(file_name, fd)
+                #the save loop raises this when it reaches the file, instead of waiting forever
+                self._hand_off(e)
+                return()
+            if not self._hand_off((file_name, fd)):
+                self._discard(file_name, fd)
+                return()
+
+    def _discard(self, file_name, fd):
+        os.close(fd)
+        os.remove(file_name)
+
+    def next(self):
+        '''
+        Take the next ready batch file.
+        Returns:
+            file_name (str): path of the batch file
+            fd (int): open file descriptor, preallocated
+        '''
+        item = self.ready.get()
+        if isinstance(item, Exception):
+            raise item
+        return(item)
+
+    def close(self, timeout=5):
+        '''
+        Stop preparing files and remove any that were prepared but not used.
+        Params:
+            timeout (float): seconds to wait for a file being prepared (eg on a stalled disk)
+        '''
+        self.stop.set()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print(f'Batch file preparer still busy after {timeout} seconds, leaving it behind.')
+        while not self.ready.empty():
+            item = self.ready.get()
+            if not isinstance(item, Exception):
+                self._discard(*item)
+
+def batch_file_name(fstart, ims_per_file):
+    '''
+    Name of the batch file that starts at collection index fstart.
+    '''
+    if(ims_per_file == 1):
+        return(f'frame_{fstart}.bin')
+    return(f'frames_{fstart}_{fstart+ims_per_file-1}.bin')
+
+def save_queue_worker(cam_name, save_queue_out, frame_pool, save_folder, ims_per_file=200, write_size=8*2**20,
+                      durability='write', sync_every_frames=200, sync_every_ms=1000, metrics=None,
+                      volumes=None, volume_weights=None, done=None, cam_names=None, arrival_ring=None):
+    '''
+    Write one camera's frames from its save queue into batch files, recording timestamps,
+    the batch manifest and session metadata in save_folder.
+    Params:
+        cam_name (str): name of camera (od/os/cy)
+        save_queue_out (queue): queue of frame_data slot descriptors
+        frame_pool (FramePool): slots the frames live in
+        save_folder (str): folder for timestamps, manifest and metadata
+        ims_per_file (int): frames per batch file
+        write_size (int): bytes per disk write
+        durability (str): 'write', 'group' or 'close', see BatchWriter
+        sync_every_frames (int): group commit frame interval
+        sync_every_ms (float): group commit time interval
+        metrics (PipelineMetrics): live counters to update
+        volumes (list of str): folders (ideally on separate disks) to stripe batch files across,
+                               just save_folder if None
+        volume_weights (list of int): relative share of batch files for each volume
+        done (Event): set once every frame is written and all files are finalized
+        cam_names (list of str): every camera's name, for inter-camera timing statistics
+        arrival_ring (mp.Array): arrival times shared between save workers (see TimingStats)
+    '''
 #     keyboard_interrupt = False
 #     def _internal_callback(signum, frame):
 #         keyboard_interrupt = True
 #     #setup folder structure and file
 #     signal.signal(signal.SIGINT, _internal_callback)
 
-    if not os.path.exists(os.path.join(save_folder, cam_name)):
-        os.makedirs(os.path.join(save_folder, cam_name))
-        os.chmod(save_folder, stat.S_IRWXO)
-    ts_file_name = os.path.join(save_folder, f"timestamps_{cam_name}.tsv")
-    #make a newtimestamp file
-    with open(ts_file_name, 'w') as ts_file:
-        ts_file.write(f"nframe\ttime\n")
-    #open it for appending
-    ts_file = open(ts_file_name, 'a+')
-    #ts_file = os.open(ts_file_name, os.O_WRONLY | os.O_CREAT , 0o777 | os.O_APPEND | os.O_SYNC | os.O_DIRECT)
-    i = 0
-#     grbgim = save_queue_out.get()
-    #grbgim = save_pipe_out.recv()
-#     grbgim = grbgim.raw_data
-    #imstr_array = bytearray(ims_per_file * grbgim) #empty byte string the size of image batches
+    if(metrics is None):
+        metrics = PipelineMetrics()
+    if(volumes is None):
+        volumes = [save_folder]
+    volumes = [os.path.abspath(volume) for volume in volumes]
+    for volume in volumes:
+        if not os.path.exists(os.path.join(volume, cam_name)):
+            os.makedirs(os.path.join(volume, cam_name))
+            os.chmod(volume, stat.S_IRWXO)
+        capfmt.write_metadata_pointer(volume, save_folder, cam_name)
+    stripes = capfmt.stripe_pattern(len(volumes), volume_weights)
+    manifest = capfmt.BatchManifestWriter(capfmt.manifest_file_name(save_folder, cam_name))
+    ts_index = capfmt.TimestampIndexWriter(capfmt.timestamp_index_file_name(save_folder, cam_name))
+    writer = BatchWriter(write_size, durability, sync_every_frames, sync_every_ms)
+    capfmt.write_session_metadata(save_folder, cam_name,
+                                  ims_per_file=ims_per_file,
+                                  write_size=writer.write_size,
+                                  durability=writer.durability_metadata(),
+                                  volumes=volumes,
+                                  volume_weights=volume_weights)
+    bin_file_names = (os.path.join(volumes[stripes[i % len(stripes)]], cam_name, batch_file_name(i*ims_per_file, ims_per_file))
+                      for i in itertools.count())
+    timing = TimingStats(cam_names or [cam_name], cam_name, arrival_ring)
+    preparer = None
+    n_saved = 0
+    n_discarded = 0
+    pending_slot = None
+    save_error = None
     try:
-        if(ims_per_file == 1):
-            while True:
-                bin_file_name = os.path.join(save_folder, cam_name, f'frame_{i}.bin')
-                f = os.open(bin_file_name, os.O_WRONLY | os.O_CREAT , 0o777 | os.O_TRUNC | os.O_SYNC | os.O_DIRECT)
-                image = save_queue_out.get()
-                os.write(f, image.raw_data)
-                ts_file.write(f"{i}\t{image.nframe}\t{image.tsSec}.{str(image.tsUSec).zfill(6)}\n")
-                i+=1
-        else:
-            while True:
-                fstart=i*ims_per_file
-                bin_file_name = os.path.join(save_folder, cam_name, f'frames_{fstart}_{fstart+ims_per_file-1}.bin')
-                f = os.open(bin_file_name, os.O_WRONLY | os.O_CREAT , 0o777 | os.O_TRUNC | os.O_SYNC | os.O_DIRECT)
-                for j in range(ims_per_file):
-                    image = save_queue_out.get()
-                    os.write(f, image.raw_data)
-                    ts_file.write(f"{fstart+j}\t{image.nframe}\t{image.tsSec}.{str(image.tsUSec).zfill(6)}\n")
-
-                os.close(f)
-                i+=1
+        #frames arrive until acquisition posts END_OF_STREAM
+        for image in iter(save_queue_out.get, END_OF_STREAM):
+            pending_slot = image.slot
+            if(preparer is None):
+                #batch files are created and preallocated ahead of time once the frame size is known
+                frame_size = frame_pool.wait_allocated()
+                preparer = BatchFilePreparer(writer.open, bin_file_names, ims_per_file*frame_size)
+            i, j = divmod(n_saved, ims_per_file)
+            if(j == 0):
+                bin_file_name, fd = preparer.next()
+                writer.start(fd)
+                manifest.add(i, n_saved, stripes[i % len(stripes)], bin_file_name)
+            metrics.frame_pending(image.t_acquired)
+            writer.write(frame_pool.view(image.slot))
+            frame_pool.release(image.slot)
+            pending_slot = None
+            metrics.frame_written(frame_size)
+            ts_index.append(n_saved, image.nframe, image.tsSec, image.tsUSec, i, j*frame_size)
+            timing.frame_saved(n_saved, image.nframe, image.tsSec + image.tsUSec*1e-6, image.t_acquired, time.monotonic())
+            n_saved += 1
+            if(j == ims_per_file - 1):
+                writer.close()
+                ts_index.flush()
 
     except Exception as e:
 
         print(e)
-        print('Exiting Save Thread')
+        print(f'Error in {cam_name} Save Thread. Discarding remaining frames.')
+        save_error = f'{type(e).__name__}: {e}'
+        #keep handing slots back so acquisition is never left waiting on a full pool
+        if(pending_slot is not None):
+            frame_pool.release(pending_slot)
+            n_discarded += 1
+        for image in iter(save_queue_out.get, END_OF_STREAM):
+            frame_pool.release(image.slot)
+            n_discarded += 1
+        print(f'{cam_name} save worker discarded {n_discarded} frames')
 
-##TODO: Safely handle a keyboard interrupt by continuing to save data until the pipes are empty
-#     except KeyboardInterrupt:
-#         print(f'{component_name} Detected Keyboard Interrupt. Finishing Saving Before Stopping. Send another Interrupt to stop saving')
+    finally:
+        try:
+            #finalize the partial last batch, and remove batch files prepared but never used
+            if(writer.fd is not None):
+                writer.close()
+            if(preparer is not None):
+                preparer.close()
+            ts_index.close()
+            manifest.close()
+            capfmt.write_session_metadata(save_folder, cam_name, frames_saved=n_saved,
+                                          frames_discarded=n_discarded, save_error=save_error)
+            timing_dict = timing.to_dict()
+            timing_dict['discarded'] = n_discarded
+            with open(capfmt.timing_file_name(save_folder, cam_name), 'w') as f:
+                yaml.dump(timing_dict, f, default_flow_style=False)
+        except Exception as e:
+            print(f'Error finalizing {cam_name} files: {e}')
+            try:
+                capfmt.write_session_metadata(save_folder, cam_name, save_error=f'{type(e).__name__}: {e}')
+            except Exception:
+                pass
+        finally:
+            #always report finished, so draining reports the error rather than a timeout
+            if(done is not None):
+                done.set()
 
-#     except:
-#         print('There was an Error in the save Thread!')
-#     finally:
-#         os.close(f)
-#         os.close(ts_file)
+def save_queue_process(*args, **kwargs):
+    '''
+    save_queue_worker as the body of a save worker process (see ximea_acquire save_processes).
+    Ctrl-C reaches every process in the group, so the worker ignores SIGINT and only stops
+    once acquisition posts END_OF_STREAM, writing every frame still queued.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    save_queue_worker(*args, **kwargs)
 
-def acquire_camera(cam_id, cam_name, sync_queue_in, save_queue_in, max_collection_seconds, stop_collecting,
-                   component_name='SCENE_CAM'):
+def acquire_camera(cam_id, cam_name, sync_queue_in, save_queue_in, frame_pool, max_collection_seconds, stop_collecting,
+                   component_name='SCENE_CAM', backend=None, metrics=None, save_folder=None, sync_requested=None,
+                   packed_bit_depth=None):
 
     """
     Acquire frames from a single camera.
@@ -225,9 +1147,15 @@ def acquire_camera(cam_id, cam_name, sync_queue_in, save_queue_in, max_collectio
         cam_id (str):  The serial number of the camera
         cam_name (str): A text name for the camera
         sync_queue (queue.Queue): A queue which accepts the sync strings
-        save_queue (queue.Queue): A queue which accepts xiapi.Images
+        save_queue (queue.Queue): A queue which accepts frame_data slot descriptors
+        frame_pool (FramePool): preallocated slots frames are copied into
         max_collection_seconds (int): the maximum number of seconds to run
         stop_collecting (threading.Event): keep collecting until this is set
+        backend (module): provides Camera and Image, xiapi by default (see ximea_sim)
+        metrics (PipelineMetrics): live counters to update
+        save_folder (str): folder to record the camera's frame layout in (session metadata)
+        sync_requested (threading.Event): when set, take a clock sync sample between frames (see ClockSyncSampler)
+        packed_bit_depth (int): record 10 or 12 bit PFNC LSB packed pixels, overriding the config file (see enable_bit_packing)
 
         Any keywords which are present in default_settings may also be passed as
         keyword arguments to this function as well.
@@ -242,31 +1170,64 @@ def acquire_camera(cam_id, cam_name, sync_queue_in, save_queue_in, max_collectio
 
     """
     keep_collecting=True
+    if(backend is None):
+        backend = xiapi
+    if(metrics is None):
+        metrics = PipelineMetrics()
 
     try:
         print(f'{component_name} Opening Camera {cam_name}')
-        camera = xiapi.Camera()
+        camera = backend.Camera()
         camera.open_device_by_SN(cam_id)
 
         apply_cam_settings(camera, cam_name+".yaml")
+        if(packed_bit_depth is not None):
+            enable_bit_packing(camera, packed_bit_depth)
+        img_format, bit_depth = get_frame_format(camera)
         framerate = camera.__getattribute__(f"get_framerate")()
-        max_frames = np.int(np.around(max_collection_seconds * framerate))
+        max_frames = int(np.around(max_collection_seconds * framerate))
+        frame_pool.allocate(get_frame_size(camera), framerate)
+        if(save_folder is not None):
+            settings = get_capture_settings(camera)
+            capfmt.write_session_metadata(save_folder, cam_name,
+                                          width=camera.get_width(),
+                                          height=camera.get_height(),
+                                          offset_x=settings.get('offsetX', 0),
+                                          offset_y=settings.get('offsetY', 0),
+                                          binning=[settings.get('binning_horizontal', 1), settings.get('binning_vertical', 1)],
+                                          decimation=[settings.get('decimation_horizontal', 1), settings.get('decimation_vertical', 1)],
+                                          framerate=framerate,
+                                          img_format=img_format,
+                                          bit_depth=bit_depth,
+                                          bayer_pattern=capture_bayer_pattern(settings),
+                                          camera_settings=settings)
 
         print(f'{component_name} Recording Timestamp Syncronization Pre...')
         sync_str = get_sync_string(cam_name + "_pre", camera)
         sync_queue_in.put(sync_str)
 
         camera.start_acquisition()
-        image = xiapi.Image()
+        image = backend.Image()
 
         print(f'{component_name} Begin Recording for up to {max_frames} frames...')
         for i in range(max_frames):
-            camera.get_image(image)
-            data = image.get_image_data_raw()
-            save_queue_in.put(frame_data(data,
+            slot = frame_pool.acquire()
+            try:
+                camera.get_image(image)
+                frame_pool.fill(slot, image)
+            except BaseException:
+                #the slot never made it into the save queue, hand it back so the pool does not shrink
+                frame_pool.release(slot)
+                raise
+            metrics.frame_acquired(image.nframe)
+            save_queue_in.put(frame_data(slot,
                                    image.nframe,
                                    image.tsSec,
-                                   image.tsUSec))
+                                   image.tsUSec,
+                                   time.monotonic()))
+            if(sync_requested is not None and sync_requested.is_set()):
+                sync_requested.clear()
+                sync_queue_in.put(get_sync_string(cam_name + "_run", camera))
             if(stop_collecting.is_set()):
                 break
 
@@ -280,13 +1241,92 @@ def acquire_camera(cam_id, cam_name, sync_queue_in, save_queue_in, max_collectio
         sync_queue_in.put(sync_str)
 
     finally:
+        #tell the save worker the stream has ended, whatever stopped it
+        save_queue_in.put(END_OF_STREAM)
         print(f"{component_name} Camera {cam_name} Cleanup...")
         camera.stop_acquisition()
         camera.close_device()
         print(f"{component_name} Camera {cam_name} aquisition finished")
 
 
-def ximea_acquire(save_folders_list, max_collection_mins=1, ims_per_file=100, component_name='SCENE_CAM', memsize=10, num_cameras=3):
+def drain_save_workers(cam_names, save_workers, save_done, frame_pools, drain_timeout, component_name='SCENE_CAM',
+                       save_folders=None, metrics=None):
+    '''
+    Wait, with one shared deadline, for save workers to write their remaining frames and
+    finalize their files after END_OF_STREAM, and report what was left unsaved.
+    Params:
+        cam_names (list of str): camera names
+        save_workers (list of Thread/Process): save workers
+        save_done (list of Event): events the save workers set when they are finished
+        frame_pools (list of FramePool): each camera's frame pool
+        drain_timeout (float): total seconds to wait
+        save_folders (list of str): each camera's save folder, to report errors save workers recorded there
+        metrics (list of PipelineMetrics): each camera's metrics, to check every acquired frame was written
+    Returns:
+        leftover_frames (dict): camera name -> frames acquired but not saved
+    '''
+    deadline = time.monotonic() + drain_timeout
+    leftover_frames = {}
+    save_errors = 0
+    for i, worker in enumerate(save_workers):
+        if(save_done[i].wait(max(deadline - time.monotonic(), 0))):
+            worker.join(max(deadline - time.monotonic(), 0))
+            save_error = capfmt.read_session_metadata(save_folders[i], cam_names[i]).get('save_error') if save_folders else None
+            if(save_error is not None):
+                save_errors += 1
+                print(f'{component_name} Save worker for {cam_names[i]} failed: {save_error}')
+            if(metrics is not None):
+                counts = metrics[i].snapshot()
+                unsaved = int(counts['acquired'] - counts['written'])
+                if(unsaved > 0):
+                    leftover_frames[cam_names[i]] = unsaved
+                    print(f'{component_name} Save worker for {cam_names[i]} wrote {int(counts["written"])} of '
+                          f'{int(counts["acquired"])} acquired frames, {unsaved} frames unsaved')
+        else:
+            leftover_frames[cam_names[i]] = frame_pools[i].in_use()
+            print(f'{component_name} Save worker for {cam_names[i]} did not finish, '
+                  f'{leftover_frames[cam_names[i]]} frames left unsaved')
+    if not (leftover_frames or save_errors):
+        print(f"{component_name} All frames saved. Camera Collection Finished.")
+    return(leftover_frames)
+
+def ximea_acquire(save_folders_list, max_collection_mins=1, ims_per_file=100, component_name='SCENE_CAM', memsize=None, num_cameras=3,
+                  write_size=8*2**20, durability='write', sync_every_frames=200, sync_every_ms=1000,
+                  save_processes=False, backend=None, telemetry_interval=1.0, telemetry_port=None,
+                  volume_weights=None, drain_timeout=60, sync_interval=5.0, pupil_port=None, packed_bit_depth=None,
+                  buffer_seconds=2.0):
+    '''
+    Acquire and save frames from all ximea cameras.
+    Params:
+        save_folders_list (list of str): folders to save frames into, ideally on separate disks.
+                                         Every camera's batch files are striped across all of them,
+                                         timestamps, manifests and metadata go in the first.
+        max_collection_mins (float): maximum number of minutes to record
+        ims_per_file (int): how many frames per .bin batch file?
+        memsize (float): GB of RAM for frame pools, split evenly across cameras. If None, each camera's
+                         pool holds buffer_seconds of frames at its framerate. Either way this is the most
+                         the pools can hold while the disks fall behind, not what they use while keeping up.
+        num_cameras (int): how many cameras to record from
+        write_size (int): bytes per disk write in the save threads
+        durability (str): 'write' (O_SYNC every write), 'group' (fdatasync every
+                          sync_every_frames frames or sync_every_ms ms) or 'close' (fdatasync per batch file)
+        sync_every_frames (int): group commit frame interval
+        sync_every_ms (float): group commit time interval
+        save_processes (bool): run each camera's save worker in its own process, fed through
+                               shared memory frame slots, instead of a thread
+        backend (module): camera backend, xiapi by default. Use ximea_sim to run without cameras.
+        telemetry_interval (float): seconds between pipeline telemetry samples written to telemetry.tsv
+        telemetry_port (int): also send telemetry samples as UDP datagrams to this localhost port
+        volume_weights (list of int): relative share of batch files for each save folder
+                                      (eg sustained MB/s of each disk), equal if None
+        drain_timeout (float): seconds to wait for save workers to finish writing after acquisition ends
+        sync_interval (float): seconds between camera/wall clock sync samples during acquisition
+        pupil_port (int): pupil remote port to also sample pupil/wall clock pairs from, None to skip
+        packed_bit_depth (int): record 10 or 12 bit pixels with PFNC LSB bit packing, as set in the camera config files if None
+        buffer_seconds (float): seconds of frames each camera's pool holds when memsize is None
+    Returns:
+        leftover_frames (dict): camera name -> frames still unsaved when the drain timed out
+    '''
 
     # 3 x save_queues
     # 3 x sync_queues
@@ -301,12 +1341,18 @@ def ximea_acquire(save_folders_list, max_collection_mins=1, ims_per_file=100, co
     #           'cy': "XECAS1930001",
     #           'os': "XECAS1922001"}
 
-    save_folders = [save_folders_list[0],
-                    save_folders_list[0], # this line should be [0] when using 3 camears
-                    save_folders_list[0]
-                   ]
+    #timestamps, manifests and metadata live in the first folder, batch files are striped across all
+    save_folders = [save_folders_list[0] for _ in cameras]
 
-    save_queues = [queue.Queue() for _ in cameras]
+    if(save_processes):
+        save_queues = [mp.Queue() for _ in cameras]
+        save_worker = mp.Process
+    else:
+        save_queues = [queue.Queue() for _ in cameras]
+        save_worker = threading.Thread
+    frame_pools = [FramePool(None if memsize is None else memsize * 2**30 / num_cameras, shared=save_processes,
+                             buffer_seconds=buffer_seconds) for _ in cameras]
+    metrics = [PipelineMetrics() for _ in cameras]
     sync_queues = [queue.Queue() for _ in cameras]
 
     for save_folder in save_folders_list:
@@ -315,33 +1361,74 @@ def ximea_acquire(save_folders_list, max_collection_mins=1, ims_per_file=100, co
             os.chmod(save_folder, stat.S_IRWXO)
 
 
+    #every session starts from fresh metadata, also when a folder is reused
+    for i, cam_name in enumerate(cameras):
+        capfmt.reset_session_metadata(save_folders[i], cam_name)
+
+    arrival_ring = TimingStats.new_arrival_ring(len(cameras))
     stop_collecting = threading.Event()
+    save_done = [(mp.Event() if save_processes else threading.Event()) for _ in cameras]
+    save_threads = []
+    acquisition_threads = []
+    sampler = None
+    clock_sampler = None
 
     try:
-        #start save threads
-        save_threads = []
+        #start save threads (or processes)
         for i, cam in enumerate(cameras):
-            proc = threading.Thread(target=save_queue_worker, args=(cam,
+            proc = save_worker(target=(save_queue_process if save_processes else save_queue_worker), args=(cam,
                                                  save_queues[i],
+                                                 frame_pools[i],
                                                  save_folders[i],
-                                                 ims_per_file))
+                                                 ims_per_file,
+                                                 write_size,
+                                                 durability,
+                                                 sync_every_frames,
+                                                 sync_every_ms,
+                                                 metrics[i],
+                                                 save_folders_list,
+                                                 volume_weights,
+                                                 save_done[i],
+                                                 list(cameras),
+                                                 arrival_ring))
             proc.daemon = True
             proc.start()
             save_threads.append(proc)
 
+        pupil_time_fn = None
+        if(pupil_port is not None):
+            import zmq_socket as zmqs
+            pupil_socket = zmqs.ZMQsocket(port=pupil_port, component_name=component_name)
+            pupil_socket.connect()
+            pupil_time_fn = pupil_socket.get_time
+        clock_sampler = ClockSyncSampler(list(cameras), sync_interval, pupil_time_fn,
+                                         os.path.join(save_folders_list[0], 'timestamp_camsync_pupil.tsv'))
+        clock_sampler.start()
+
         #start aquisition threads
-        acquisition_threads = []
         for i, (cam_name, cam_sn) in enumerate(cameras.items()):
             proc = threading.Thread(target=acquire_camera,
                               args=(cam_sn,
                                     cam_name,
                                     sync_queues[i],
                                     save_queues[i],
+                                    frame_pools[i],
                                     max_collection_mins*60,
-                                    stop_collecting))
+                                    stop_collecting,
+                                    component_name,
+                                    backend,
+                                    metrics[i],
+                                    save_folders[i],
+                                    clock_sampler.sync_requested[cam_name],
+                                    packed_bit_depth))
             proc.daemon = False
             acquisition_threads.append(proc)
 
+        sampler = MetricsSampler(list(cameras), metrics, frame_pools, save_queues,
+                                 os.path.join(save_folders_list[0], 'telemetry.tsv'),
+                                 telemetry_interval, telemetry_port)
+        sampler.start()
+
         print(f"{component_name} Starting Acquisition threads...")
         for proc in acquisition_threads:
             proc.start()
@@ -350,22 +1437,29 @@ def ximea_acquire(save_folders_list, max_collection_mins=1, ims_per_file=100, co
             proc.join()
         print(f"{component_name} Finished Aquiring...")
 
-        print(f"{component_name} Saving Timestamp Sync Information...")
-        for i, (cam_name, cam_sn) in enumerate(cameras.items()):
-            write_sync_queue(sync_queues[i], cam_name, save_folders[i])
-
-        print(f"{component_name} Waiting for Save Queues to Empty...")
-        for q in save_queues:
-            while not q.empty():
-                time.sleep(1)
-                #q_size = [q.qsize() for q in save_queues]
-                #print(f'Queue size is {q_size}')
-
-        print(f"{component_name} Pipes are Empty. Camera Collection Finished without Interrupt")
-
     except KeyboardInterrupt:
         print(f'{component_name} Detected Keyboard Interrupt (main thread). Stopping Camera Acquisition')
         stop_collecting.set()
+        for proc in acquisition_threads:
+            if(proc.is_alive()):
+                proc.join()
 
     finally:
+        if(clock_sampler is not None):
+            clock_sampler.stop()
+        print(f"{component_name} Saving Timestamp Sync Information...")
+        for i, (cam_name, cam_sn) in enumerate(cameras.items()):
+            write_sync_queue(sync_queues[i], cam_name, save_folders[i])
+
+        #every acquisition thread has posted END_OF_STREAM, save workers finish and finalize their files
+        print(f"{component_name} Waiting up to {drain_timeout} seconds for Save Workers to Finish...")
+        leftover_frames = drain_save_workers(list(cameras), save_threads, save_done, frame_pools, drain_timeout, component_name,
+                                             save_folders, metrics)
+        if(sampler is not None):
+            sampler.stop()
+        print_timing_summary(write_timing_summary(save_folders_list[0], list(cameras)), component_name)
+        for frame_pool in frame_pools:
+            frame_pool.close()
         print(f"{component_name} All Finished - Ending Ximea Camera Now.")
+
+    return(leftover_frames)
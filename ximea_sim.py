@@ -0,0 +1,283 @@
+'''
+Simulated stand-in for the parts of ximea.xiapi that acquisition uses, so the capture
+pipeline can be run and benchmarked without XIMEA cameras attached.
+
+Pass this module (or backend(...) for drops/jitter) as the backend to
+ximea_cam_aquire_save.acquire_camera / ximea_acquire.
+'''
+
+import time
+import ctypes
+import functools
+import types
+import numpy as np
+import capture_format as capfmt
+
+# camera parameters the simulated camera understands, with the values a freshly opened camera reports.
+# covers the settings in the cy/os/od.yaml configs so apply_cam_settings can set all of them.
+DEFAULT_PARAMS = {'width': 2064,
+                  'height': 1544,
+                  'offsetX': 0,
+                  'offsetY': 0,
+                  'downsampling': 1,
+                  'downsampling_type': 'XI_BINNING',
+                  'decimation_horizontal': 1,
+                  'decimation_vertical': 1,
+                  'binning_horizontal': 1,
+                  'binning_vertical': 1,
+                  'binning_selector': 'XI_BIN_SELECT_SENSOR',
+                  'binning_horizontal_mode': 'XI_BIN_MODE_SUM',
+                  'binning_vertical_mode': 'XI_BIN_MODE_SUM',
+                  'binning_horizontal_pattern': 'XI_BIN_BAYER',
+                  'binning_vertical_pattern': 'XI_BIN_BAYER',
+                  'decimation_selector': 'XI_DEC_SELECT_SENSOR',
+                  'decimation_horizontal_pattern': 'XI_DEC_BAYER',
+                  'decimation_vertical_pattern': 'XI_DEC_BAYER',
+                  'framerate': 200.0,
+                  'exposure': 4850,
+                  'gain': 0,
+                  'gain_selector': 'XI_GAIN_SELECTOR_ALL',
+                  'gammaC': 0.8,
+                  'gammaY': 0.47,
+                  'image_black_level': 0,
+                  'aeag_level': 50,
+                  'aeag_roi_height': 1544,
+                  'aeag_roi_offset_x': 0,
+                  'aeag_roi_offset_y': 0,
+                  'aeag_roi_width': 2064,
+                  'ae_max_limit': 200000,
+                  'ag_max_limit': 24.0,
+                  'exp_priority': 1.0,
+                  'LUTIndex': 4095,
+                  'LUTValue': 4095,
+                  'color_filter_array': 'XI_CFA_BAYER_GRBG',
+                  'cms': 'XI_CMS_DIS',
+                  'cms_intent': 'XI_CMS_INTENT_PERCEPTUAL',
+                  'cooling': 'XI_TEMP_CTRL_MODE_OFF',
+                  'counter_selector': 'XI_CNT_SEL_TRANSPORT_SKIPPED_FRAMES',
+                  'cam_simulators_count': 0,
+                  'debug_level': 'XI_DL_WARNING',
+                  'ext_feature': 0,
+                  'ext_feature_selector': 'XI_EXT_FEATURE_SEL_DITHERING_HOST',
+                  'imgdataformat': 'XI_RAW8',
+                  'imgdataformatrgb32alpha': 0,
+                  'image_data_bit_depth': 'XI_BPP_8',
+                  'output_bit_depth': 'XI_BPP_8',
+                  'sensor_bit_depth': 'XI_BPP_8',
+                  'output_bit_packing_type': 'XI_DATA_PACK_PFNC_LSB_PACKING',
+                  'acq_timing_mode': 'XI_ACQ_TIMING_MODE_FRAME_RATE_LIMIT',
+                  'acq_buffer_size': 100000000,
+                  'acq_buffer_size_unit': 1,
+                  'acq_frame_burst_count': 1,
+                  'buffers_queue_size': 4,
+                  'buffer_policy': 'XI_BP_UNSAFE',
+                  'exposure_burst_count': 1,
+                  'limit_bandwidth': 10000,
+                  'limit_bandwidth_mode': 'XI_OFF',
+                  'proc_num_threads': 8,
+                  'sensor_output_channel_count': 'XI_CHANN_CNT16',
+                  'sensor_taps': 'XI_TAP_CNT_1',
+                  'sharpness': 0.0,
+                  'shutter_type': 'XI_SHUTTER_GLOBAL',
+                  'temp_selector': 'XI_TEMP_SENSOR_BOARD',
+                  'test_pattern': 'XI_TESTPAT_OFF',
+                  'test_pattern_generator_selector': 'XI_TESTPAT_GEN_FPGA',
+                  'transport_data_target': 'XI_TRANSPORT_DATA_TARGET_CPU_RAM',
+                  'trigger_delay': 0,
+                  'trigger_overlap': 'XI_TRG_OVERLAP_READ_OUT',
+                  'trigger_selector': 'XI_TRG_SEL_FRAME_START',
+                  'trigger_source': 'XI_TRG_OFF',
+                  'ts_rst_mode': 'XI_TS_RST_ARM_ONCE',
+                  'ts_rst_source': 'XI_TS_RST_OFF',
+                  'wb_kb': 1.0,
+                  'wb_kg': 1.0,
+                  'wb_kr': 1.0,
+                  'wb_roi_height': 0,
+                  'wb_roi_offset_x': 0,
+                  'wb_roi_offset_y': 0,
+                  'wb_roi_width': 0,
+                  'is_aeag': False,
+                  'is_apply_cms': False,
+                  'is_auto_bandwidth_calculation': False,
+                  'is_auto_wb': False,
+                  'is_bpc': False,
+                  'is_cam_enum_golden_enabled': False,
+                  'is_cam_sensor_init_disabled': False,
+                  'is_ffc': False,
+                  'is_gentl_stream_en': False,
+                  'is_horizontal_flip': False,
+                  'is_LUTEnable': False,
+                  'is_new_process_chain_enable': True,
+                  'is_output_bit_packing': False,
+                  'is_recent_frame': False,
+                  'is_vertical_flip': False}
+
+BIT_DEPTHS = {'XI_BPP_8': 8, 'XI_BPP_10': 10, 'XI_BPP_12': 12, 'XI_BPP_16': 16}
+
+class Xi_error(Exception):
+    '''
+    Raised where xiapi would raise an Xi_error.
+    '''
+    pass
+
+class Image:
+    '''
+    Simulated xiapi.Image. bp points at the raw data of the last frame, as in xiapi.
+    '''
+    def __init__(self):
+        self.bp = None
+        self.bp_size = 0
+        self.width = 0
+        self.height = 0
+        self.frm = None
+        self.nframe = 0
+        self.tsSec = 0
+        self.tsUSec = 0
+
+    def get_bytes_per_pixel(self):
+        return(1 if self.frm in ('XI_RAW8', 'XI_FRM_TRANSPORT_DATA') else 2)
+
+    def get_image_data_raw(self):
+        return(ctypes.string_at(self.bp, self.bp_size))
+
+class Camera:
+    '''
+    Simulated xiapi.Camera producing Bayer frames at the configured framerate and resolution.
+
+    Frames are produced on a fixed schedule from start_acquisition. When get_image is called
+    late, frames older than buffers_queue_size are overwritten and show up as nframe gaps,
+    as they would on a real camera whose consumer falls behind.
+    Params:
+        drop_probability (float): chance of dropping each frame on the camera side
+        jitter_us (float): standard deviation of timestamp jitter in microseconds
+        clock_drift_ppm (float): how fast the camera clock runs compared to the wall clock
+        seed (int): random seed for drops and jitter
+        n_patterns (int): number of distinct frames to cycle through
+    '''
+    def __init__(self, drop_probability=0.0, jitter_us=0.0, clock_drift_ppm=0.0, seed=None, n_patterns=8):
+        self.params = dict(DEFAULT_PARAMS)
+        self.drop_probability = drop_probability
+        self.jitter_us = jitter_us
+        self.clock_rate = 1 + clock_drift_ppm*1e-6
+        self.rng = np.random.default_rng(seed)
+        self.n_patterns = n_patterns
+        self.serial_number = None
+        self.acquiring = False
+        #xiapi exposes every parameter as get_/set_ (or is_/enable_/disable_) methods
+        for key in self.params:
+            if key.startswith('is_'):
+                setattr(self, key, functools.partial(self._param, 'is_', key))
+                setattr(self, 'enable_' + key[3:], functools.partial(self._param, 'enable_', key))
+                setattr(self, 'disable_' + key[3:], functools.partial(self._param, 'disable_', key))
+            else:
+                setattr(self, 'get_' + key, functools.partial(self._param, 'get_', key))
+                setattr(self, 'set_' + key, functools.partial(self._param, 'set_', key))
+
+    def _param(self, op, key, value=None):
+        if(op in ('get_', 'is_')):
+            return(self.params[key])
+        if(self.acquiring and key in ('width', 'height', 'imgdataformat', 'output_bit_depth', 'is_output_bit_packing')):
+            raise Xi_error(f'Cannot set {key} while acquiring')
+        if(op == 'set_'):
+            self.params[key] = value
+        else:
+            self.params[key] = (op == 'enable_')
+
+    def open_device_by_SN(self, serial_number):
+        self.serial_number = serial_number
+        self.t_open = time.monotonic()
+
+    def close_device(self):
+        self.serial_number = None
+
+    def _camera_time(self, t_monotonic):
+        return((t_monotonic - self.t_open) * self.clock_rate)
+
+    def get_param(self, name):
+        if(name == 'timestamp'):
+            #camera clock in nanoseconds
+            return(int(self._camera_time(time.monotonic()) * 1e9))
+        return(self.params[name])
+
+    def set_param(self, name, value):
+        self._param('set_', name, value)
+
+    def _make_patterns(self):
+        '''
+        Pregenerate Bayer (GR) mosaics of a gradient with a bar that moves from frame to frame,
+        PFNC LSB packed when output bit packing is on.
+        '''
+        height, width = self.params['height'], self.params['width']
+        bit_depth = BIT_DEPTHS.get(self.params['output_bit_depth'], 8)
+        packed = self.params['is_output_bit_packing']
+        if(self.params['imgdataformat'] == 'XI_RAW8' and not packed):
+            dtype, max_value = np.uint8, 255
+        else:
+            dtype, max_value = np.dtype('<u2'), 2**bit_depth - 1
+        rows, cols = np.mgrid[0:height, 0:width]
+        scene = (cols / width)[None] * np.array([0.9, 0.6, 0.3])[:, None, None] \
+                + (rows / height)[None] * np.array([0.1, 0.3, 0.6])[:, None, None]
+        patterns = []
+        for k in range(self.n_patterns):
+            frame = scene.copy()
+            bar = slice(k*width//self.n_patterns, (k+1)*width//self.n_patterns)
+            frame[:, :, bar] = 1 - frame[:, :, bar]
+            red, green, blue = frame
+            mosaic = green.copy()
+            mosaic[0::2, 1::2] = red[0::2, 1::2]
+            mosaic[1::2, 0::2] = blue[1::2, 0::2]
+            pattern = np.ascontiguousarray((mosaic * max_value).astype(dtype))
+            if(packed):
+                pattern = capfmt.pack_pfnc_lsb(pattern, bit_depth)
+            patterns.append(pattern)
+        return(patterns)
+
+    def start_acquisition(self):
+        self.patterns = self._make_patterns()
+        self.framerate = float(self.params['framerate'])
+        self.t_start = time.monotonic()
+        self.next_frame = 0
+        self.acquiring = True
+
+    def stop_acquisition(self):
+        self.acquiring = False
+
+    def get_image(self, image, timeout=5000):
+        '''
+        Wait for the next frame and point image at it.
+        '''
+        if not self.acquiring:
+            raise Xi_error('Acquisition not started')
+        latest = int((time.monotonic() - self.t_start) * self.framerate)
+        #frames the consumer was too slow for have been overwritten in the camera buffers
+        oldest_buffered = latest - self.params['buffers_queue_size'] + 1
+        frame = max(self.next_frame, oldest_buffered)
+        while(self.drop_probability > 0 and self.rng.random() < self.drop_probability):
+            frame += 1
+        t_frame = self.t_start + frame / self.framerate
+        wait = t_frame - time.monotonic()
+        if(wait > 0):
+            time.sleep(wait)
+        self.next_frame = frame + 1
+
+        t_cam = self._camera_time(t_frame)
+        if(self.jitter_us > 0):
+            t_cam += self.rng.normal(0, self.jitter_us) * 1e-6
+        t_cam_us = max(int(round(t_cam * 1e6)), 0)
+        pattern = self.patterns[frame % self.n_patterns]
+        image.bp = pattern.ctypes.data
+        image.bp_size = pattern.nbytes
+        image.width = self.params['width']
+        image.height = self.params['height']
+        image.frm = self.params['imgdataformat']
+        image.nframe = frame + 1
+        image.tsSec = t_cam_us // 1000000
+        image.tsUSec = t_cam_us % 1000000
+        return()
+
+def backend(**sim_settings):
+    '''
+    Backend with the same Camera/Image surface as xiapi whose cameras use the given
+    simulation settings (see Camera), eg backend(drop_probability=0.001, jitter_us=20).
+    '''
+    return(types.SimpleNamespace(Camera=functools.partial(Camera, **sim_settings), Image=Image))
@@ -89,6 +89,13 @@ class ZMQsocket:
         self.socket.send_string(f'T {time_fn()}')
         return self.socket.recv_string()
     
+    def get_time(self):
+        """
+        Current pupil time.
+        """
+        self.socket.send_string('t')
+        return float(self.socket.recv_string())
+
     # send notification:
     def notify(self, notification):
         """Sends ``notification`` to Pupil Remote"""